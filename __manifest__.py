@@ -21,10 +21,17 @@ Key Features
                 'hr_payroll',
                 ],
     'data': [
+        'security/ir.model.access.csv',
+        'data/hr_payslip_run_job_data.xml',
+        'data/hr_payslip_liability_data.xml',
         'wizard/hr_payroll_register_payment.xml',
         'wizard/hr_payroll_batchwise_register_payment.xml',
+        'wizard/hr_payslip_bank_statement_import.xml',
         'views/hr_payslip_views.xml',
         'views/account_payment_view.xml',
+        'views/hr_payslip_run_job_views.xml',
+        'views/res_company_views.xml',
+        'views/hr_payslip_liability_views.xml',
     ],
     'installable': True,
     'auto_install': False,
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import http_date
+from werkzeug.wrappers import Response
+
+from odoo import fields, http
+from odoo.http import request
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class PayslipPaymentStatus(http.Controller):
+    """ Payment status of the payslips of employees or of a batch, read with plain SQL and paginated on the payslip id.
+    The page is selected with the domain query of the ORM, so that the record rules of the user apply. Every page
+    carries an ETag and a Last-Modified header computed from the last write on its payslips and their payments, so
+    that a client polling an unchanged page gets a 304 answer after a single query. """
+
+    def _parse_ids(self, value):
+        try:
+            return [int(item) for item in (value or '').split(',') if item.strip()]
+        except ValueError:
+            raise BadRequest("Ids must be comma separated integers.")
+
+    def _get_page_query(self, employee_ids, run_id, after, limit):
+        """ Return the query selecting the ids and write dates of the payslips of the page, and its parameters """
+        Payslip = request.env['hr.payslip']
+        domain = [('company_id', 'in', request.env.user.company_ids.ids), ('id', '>', after)]
+        if employee_ids:
+            domain.append(('employee_id', 'in', employee_ids))
+        if run_id:
+            domain.append(('payslip_run_id', '=', run_id))
+        query = Payslip._where_calc(domain)
+        Payslip._apply_ir_rules(query, 'read')
+        from_clause, where_clause, params = query.get_sql()
+        return """
+            SELECT "hr_payslip".id, "hr_payslip".write_date
+              FROM {from_clause}
+             WHERE {where_clause}
+          ORDER BY "hr_payslip".id
+             LIMIT %s
+        """.format(from_clause=from_clause, where_clause=where_clause or 'TRUE'), params + [limit]
+
+    def _get_validator(self, page_query, params):
+        """ Return the number of payslips of the page, its last payslip id, and the date of the last write on its
+        payslips and their payments. """
+        request.env.cr.execute("""
+            SELECT COUNT(*), MAX(page.id),
+                   MAX(GREATEST(page.write_date,
+                                (SELECT MAX(payment.write_date)
+                                   FROM account_payment payment
+                                  WHERE payment.payslip_id = page.id),
+                                (SELECT MAX(payment.write_date)
+                                   FROM account_payment_hr_payslip_rel rel
+                                   JOIN account_payment payment ON payment.id = rel.account_payment_id
+                                  WHERE rel.hr_payslip_id = page.id)))
+              FROM ({page_query}) page
+        """.format(page_query=page_query), params)
+        return request.env.cr.fetchone()
+
+    def _get_payslips(self, page_query, params):
+        request.env.cr.execute("""
+            SELECT slip.id, slip.number, slip.name, slip.employee_id, slip.payslip_run_id, slip.state,
+                   slip.date_from, slip.date_to, currency.name, slip.total_amount, slip.residual_company_signed,
+                   slip.reconciled IS TRUE
+              FROM ({page_query}) page
+              JOIN hr_payslip slip ON slip.id = page.id
+         LEFT JOIN res_currency currency ON currency.id = slip.currency_id
+          ORDER BY slip.id
+        """.format(page_query=page_query), params)
+        keys = ['id', 'number', 'name', 'employee_id', 'payslip_run_id', 'state', 'date_from', 'date_to',
+                'currency', 'total_amount', 'amount_due', 'reconciled']
+        payslips = [dict(zip(keys, row), payments=[]) for row in request.env.cr.fetchall()]
+        if not payslips:
+            return payslips
+
+        payslips_by_id = {payslip['id']: payslip for payslip in payslips}
+        request.env.cr.execute("""
+            SELECT payment.payslip_id, payment.id, payment.name, payment.state, payment.payment_date,
+                   payment.amount, currency.name
+              FROM account_payment payment
+              JOIN res_currency currency ON currency.id = payment.currency_id
+             WHERE payment.payslip_id IN %(payslip_ids)s
+             UNION ALL
+            SELECT rel.hr_payslip_id, payment.id, payment.name, payment.state, payment.payment_date,
+                   payment.amount, currency.name
+              FROM account_payment_hr_payslip_rel rel
+              JOIN account_payment payment ON payment.id = rel.account_payment_id
+              JOIN res_currency currency ON currency.id = payment.currency_id
+             WHERE rel.hr_payslip_id IN %(payslip_ids)s
+          ORDER BY 1, 2
+        """, {'payslip_ids': tuple(payslips_by_id)})
+        for payslip_id, payment_id, name, state, date, amount, currency in request.env.cr.fetchall():
+            payslips_by_id[payslip_id]['payments'].append({
+                'id': payment_id,
+                'name': name,
+                'state': state,
+                'date': date,
+                'amount': amount,
+                'currency': currency,
+            })
+        return payslips
+
+    @http.route('/payslip_payment/status', type='http', auth='user', methods=['GET'])
+    def payment_status(self, employee_ids=None, run_id=None, after=0, limit=DEFAULT_LIMIT, **kwargs):
+        """ Return the payment status of the payslips of the given employees or batch, ordered by id, starting after
+        the payslip id given by the previous page. """
+        request.env['hr.payslip'].check_access_rights('read')
+        employee_ids = self._parse_ids(employee_ids)
+        try:
+            run_id = int(run_id or 0)
+            after = int(after or 0)
+            limit = min(max(int(limit or DEFAULT_LIMIT), 1), MAX_LIMIT)
+        except ValueError:
+            raise BadRequest("run_id, after and limit must be integers.")
+        if not employee_ids and not run_id:
+            raise BadRequest("Either employee_ids or run_id is required.")
+
+        page_query, params = self._get_page_query(employee_ids, run_id, after, limit)
+        count, last_id, last_write = self._get_validator(page_query, params)
+        etag = hashlib.sha1(('%s-%s-%s-%s' % (request.env.uid, count, last_id, last_write)).encode('utf-8')).hexdigest()
+        headers = [('ETag', '"%s"' % etag), ('Cache-Control', 'private, no-cache')]
+        if last_write:
+            headers.append(('Last-Modified', http_date(fields.Datetime.from_string(last_write))))
+
+        httprequest = request.httprequest
+        if httprequest.if_none_match:
+            not_modified = httprequest.if_none_match.contains(etag)
+        else:
+            not_modified = bool(last_write and httprequest.if_modified_since and
+                                httprequest.if_modified_since >= fields.Datetime.from_string(last_write).replace(
+                                    microsecond=0))
+        if not_modified:
+            return Response(status=304, headers=headers)
+
+        payslips = self._get_payslips(page_query, params)
+        data = {
+            'payslips': payslips,
+            'next_after': len(payslips) == limit and payslips[-1]['id'] or None,
+        }
+        return request.make_response(json.dumps(data), headers=headers + [('Content-Type', 'application/json')])
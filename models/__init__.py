@@ -1,2 +1,7 @@
-from . import hr_payslip
-from . import hr_contract
\ No newline at end of file
+from . import hr_payslip_payment_mixin
+from . import hr_payslip
+from . import hr_payslip_run_job
+from . import hr_payslip_bank_file
+from . import hr_payslip_liability
+from . import hr_contract
+from . import res_company
\ No newline at end of file
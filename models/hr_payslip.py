@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 import logging
+from collections import OrderedDict, defaultdict
 
 from odoo import _, api, fields, models, _
 
-from odoo.tools import float_is_zero
-from odoo.exceptions import ValidationError
+from odoo.tools import float_compare, float_is_zero, html_escape
+from odoo.exceptions import UserError, ValidationError
 from werkzeug import url_encode
 
+from ..profiler import get_profiler, profiled
+
 _logger = logging.getLogger(__name__)
 
 
@@ -31,8 +34,17 @@ class HrPayslip(models.Model):
 
     currency_id = fields.Many2one('res.currency', _('Currency'), default=_get_default_currency_id, required=True)
 
+    move_id = fields.Many2one(index=True)
+
     payment_ids = fields.One2many('account.payment', 'payslip_id', _('Payments'))
 
+    grouped_payment_ids = fields.Many2many('account.payment', 'account_payment_hr_payslip_rel', 'hr_payslip_id',
+                                           'account_payment_id', string=_('Grouped Payments'), readonly=True,
+                                           copy=False, help="Payments of several payslips of the employee at once.")
+
+    move_line_ids = fields.One2many('account.move.line', 'payslip_id', _('Journal Items'),
+                                    help="Journal items tagged with the payslip, such as its lines of a single salary transfer.")
+
     total_amount = fields.Monetary(string=_('Total Amount'), compute='_compute_total_amount', store=True)
 
     reconciled = fields.Boolean(string=_('Paid/Reconciled'), store=True, readonly=True, compute='_compute_residual',
@@ -53,32 +65,65 @@ class HrPayslip(models.Model):
 
     @api.multi
     def refund_sheet(self):
-        for payslip in self:
-            if any(inv.state != 'draft' for inv in payslip.payment_ids):
-                raise ValidationError(_("The payslip cannot be refunded, because it has confirmed payments!"))
-
-            if payslip.move_id:
-                payslip.move_id.line_ids.remove_move_reconcile()
-                payslip.move_id.button_cancel()
-                payslip.move_id.unlink()
-
-            copied_payslip = payslip
-            copied_payslip.set_to_draft()
-
-    @api.depends('line_ids')
+        """ Set the payslips back to draft, unreconciling their journal entries at once, then deleting them or, for
+        the companies asking for it, reversing them. """
+        if any(inv.state != 'draft' for inv in self.mapped('payment_ids') | self.mapped('grouped_payment_ids')):
+            raise ValidationError(_("The payslip cannot be refunded, because it has confirmed payments!"))
+        # the payslips paid by a salary transfer have no payment, but posted bank items
+        paid_payslips = self - self._filter_unpaid()
+        if paid_payslips:
+            raise ValidationError(_("The payslip %s cannot be refunded, because it has been paid by a salary "
+                                    "transfer!") % paid_payslips[0].name)
+
+        moves = self.mapped('move_id')
+        shared_payslips = moves and self.search([('move_id', 'in', moves.ids), ('id', 'not in', self.ids)])
+        if shared_payslips:
+            raise ValidationError(_("The journal entry of the payslip %s is shared with other payslips, which must "
+                                    "be refunded along with it!") % shared_payslips[0].name)
+        if moves:
+            moves = moves.with_context(payslip_defer_paid_state=True)
+            moves.mapped('line_ids').remove_move_reconcile()
+            reversed_moves = moves.filtered(lambda move: move.company_id.payslip_refund_reversal)
+            if reversed_moves:
+                reversed_moves.reverse_moves(date=fields.Date.context_today(self))
+            deleted_moves = moves - reversed_moves
+            if deleted_moves:
+                deleted_moves.button_cancel()
+                deleted_moves.unlink()
+
+        self.set_to_draft()
+
+    @api.depends('line_ids', 'line_ids.total')
     @api.onchange('line_ids')
     def _compute_total_amount(self):
 
         precision = self.env['decimal.precision'].precision_get('Payroll')
 
+        if len(self) == 1 or self.env.field_todo(self.env['hr.payslip.line']._fields['total']) or \
+                not all(isinstance(slip_id, int) for slip_id in self.ids):
+            # a form edit, or line totals only up to date in the cache
+            for slip in self:
+                total_amount_new = 0.0
+                for line in slip.line_ids:
+                    amount = slip.credit_note and -line.total or line.total
+                    if float_is_zero(amount, precision_digits=precision):
+                        continue
+                    total_amount_new += amount
+                slip.total_amount = total_amount_new
+            return
+
+        # sum the lines of all the payslips at once, leaving out the lines rounded to zero
+        with get_profiler(self.env).phase('total amounts', len(self)):
+            self.env.cr.execute("""
+                SELECT slip_id, SUM(total)
+                  FROM hr_payslip_line
+                 WHERE slip_id IN %s AND ROUND(total::numeric, %s) != 0
+              GROUP BY slip_id
+            """, (tuple(self.ids), precision))
+            totals = dict(self.env.cr.fetchall())
         for slip in self:
-            total_amount_new = 0.0
-            for line in slip.line_ids:
-                amount = slip.credit_note and -line.total or line.total
-                if float_is_zero(amount, precision_digits=precision):
-                    continue
-                total_amount_new += amount
-            slip.total_amount = total_amount_new
+            total_amount_new = totals.get(slip.id) or 0.0
+            slip.total_amount = slip.credit_note and -total_amount_new or total_amount_new
 
     def _update_residual(self, move_lines):
         residual = 0.0
@@ -94,49 +139,320 @@ class HrPayslip(models.Model):
 
         return residual, residual_company_signed
 
-    @api.one
+    def _get_residual_amounts(self):
+        """ Return the residual amounts of the payslips as {payslip id: (residual, residual company signed)},
+        summing the receivable and payable entries of their journal entries, payments and salary transfers per
+        payslip with a single grouped query. Payslips whose journal entry has no line are left out. """
+        AccountMoveLine = self.env['account.move.line']
+        if self.env.field_todo(AccountMoveLine._fields['amount_residual']) or \
+                not all(isinstance(payslip_id, int) for payslip_id in self.ids):
+            # pending residuals and new records only exist in the cache, sum them with the ORM
+            amounts = {}
+            for payslip in self.sudo():
+                move_lines = payslip._get_move_lines()
+                if not move_lines:
+                    continue
+                residual, residual_company_signed = payslip._update_residual(
+                    move_lines | payslip._get_transfer_lines())
+                for payment in payslip.payment_ids:
+                    if payment.move_line_ids:
+                        payment_residual, payment_residual_company_signed = payslip._update_residual(
+                            payment.move_line_ids)
+                        residual = residual + payment_residual
+                        residual_company_signed = residual_company_signed + payment_residual_company_signed
+                amounts[payslip.id] = (residual, residual_company_signed)
+            return amounts
+
+        self.env.cr.execute("""
+            SELECT line.payslip_id,
+                   BOOL_OR(line.from_move),
+                   SUM(CASE WHEN account.internal_type IN ('receivable', 'payable')
+                            THEN line.residual ELSE 0.0 END),
+                   SUM(CASE WHEN account.internal_type IN ('receivable', 'payable')
+                            THEN line.amount_residual ELSE 0.0 END)
+              FROM (SELECT slip.id AS payslip_id, TRUE AS from_move, aml.account_id, aml.amount_residual,
+                           CASE WHEN aml.currency_id = slip.currency_id THEN aml.amount_residual_currency
+                                ELSE aml.amount_residual END AS residual
+                      FROM hr_payslip slip
+                      JOIN account_move_line aml ON aml.move_id = slip.move_id
+                                                 AND (aml.payslip_id IS NULL OR aml.payslip_id = slip.id)
+                     WHERE slip.id IN %(payslip_ids)s
+                 UNION ALL
+                    SELECT slip.id AS payslip_id, FALSE AS from_move, aml.account_id, aml.amount_residual,
+                           CASE WHEN aml.currency_id = slip.currency_id THEN aml.amount_residual_currency
+                                ELSE aml.amount_residual END AS residual
+                      FROM hr_payslip slip
+                      JOIN account_payment payment ON payment.payslip_id = slip.id
+                      JOIN account_move_line aml ON aml.payment_id = payment.id
+                     WHERE slip.id IN %(payslip_ids)s
+                 UNION ALL
+                    SELECT slip.id AS payslip_id, FALSE AS from_move, aml.account_id, aml.amount_residual,
+                           CASE WHEN aml.currency_id = slip.currency_id THEN aml.amount_residual_currency
+                                ELSE aml.amount_residual END AS residual
+                      FROM hr_payslip slip
+                      JOIN account_move_line aml ON aml.payslip_id = slip.id
+                     WHERE slip.id IN %(payslip_ids)s
+                       AND aml.move_id IS DISTINCT FROM slip.move_id
+                       AND aml.payment_id IS NULL) line
+              JOIN account_account account ON account.id = line.account_id
+          GROUP BY line.payslip_id
+        """, {'payslip_ids': tuple(self.ids)})
+        return {payslip_id: (residual or 0.0, residual_company_signed or 0.0)
+                for payslip_id, from_move, residual, residual_company_signed in self.env.cr.fetchall()
+                if from_move}
+
     @api.depends(
         'state', 'line_ids',
         'payment_ids',
         'payment_ids.state',
         'move_id.line_ids.amount_residual',
-        'move_id.line_ids.currency_id')
+        'move_id.line_ids.currency_id',
+        'move_line_ids.amount_residual')
     def _compute_residual(self):
-        if self.state not in ['done', 'paid']:
+        payslips = self.filtered(lambda payslip: payslip.state in ['done', 'paid'])
+        if not payslips:
             return
 
-        move_lines = self.sudo().move_id.line_ids
-        if not move_lines:
-            return
+        profiler = get_profiler(self.env)
+        with profiler.phase('residual amounts', len(payslips)):
+            amounts = payslips._get_residual_amounts()
+        with profiler.phase('residual assignment', len(payslips)):
+            for payslip in payslips:
+                if payslip.id not in amounts:
+                    continue
+                residual, residual_company_signed = amounts[payslip.id]
 
-        residual, residual_company_signed = self._update_residual(move_lines)
+                sign = payslip.credit_note and -1 or 1
+                payslip.residual_company_signed = abs(residual_company_signed) * sign
+                payslip.residual_signed = abs(residual) * sign
+                payslip.residual = abs(residual)
 
-        for payment in self.sudo().payment_ids:
-            if payment.move_line_ids:
-                payment_residual, payment_residual_company_signed = self._update_residual(payment.move_line_ids)
-                residual = residual + payment_residual
-                residual_company_signed = residual_company_signed + payment_residual_company_signed
+                if 0.05 > payslip.residual >= 0:
+                    payslip.reconciled = True
+                else:
+                    payslip.reconciled = False
 
-        sign = self.credit_note and -1 or 1
-        self.residual_company_signed = abs(residual_company_signed) * sign
-        self.residual_signed = abs(residual) * sign
-        self.residual = abs(residual)
+    @api.multi
+    def _get_destination_accounts(self):
+        """ Return the payable account of each payslip, keyed by payslip id: the account of the credit entry of the
+        payslip journal entry, or the payable account of the employee private address if the payslip has none. """
+        accounts = {}
+        for payslip in self:
+            destination_account_id = payslip.employee_id.address_home_id.property_account_payable_id
+            move_lines = payslip._get_move_lines()
+            for line in move_lines.filtered(lambda line: line.payslip_id == payslip) or move_lines:
+                if line.credit:
+                    destination_account_id = line.account_id
+            accounts[payslip.id] = destination_account_id
+        return accounts
+
+    def _get_move_lines(self):
+        """ Return the journal items of the payslip journal entry, leaving out the items of the other payslips
+        when the entry is shared by several payslips. """
+        return self.move_id.line_ids.filtered(lambda line: not line.payslip_id or line.payslip_id == self)
+
+    def _get_transfer_lines(self):
+        """ Return the journal items of the salary transfers paying the payslip, i.e. the items tagged with the
+        payslip outside of its own journal entry and of its payments. """
+        return self.move_line_ids.filtered(lambda line: line.move_id != self.move_id and not line.payment_id)
+
+    def _get_payment_message(self, payment, amount=None, currency=None):
+        """ Return the chatter message of a payment of the payslip, the payment being an account.payment or the
+        journal entry of a salary transfer. """
+        return (_(
+            "A payment of %s %s with the reference <a href='/mail/view?%s'>%s</a> related to your expense %s has been made.") % (
+                    payment.amount if amount is None else amount, (currency or payment.currency_id).symbol,
+                    url_encode({'model': payment._name, 'res_id': payment.id}), payment.name, self.name))
 
-        precision = self.env['decimal.precision'].precision_get('Account')
-        if 0.05 > self.residual >= 0:
-            self.reconciled = True
+    @api.model
+    def _log_payments(self, payments):
+        """ Log the payments of payslips, given as (payslip, payment, amount, currency) tuples, in the chatter. A
+        payment run collecting the messages in the payslip_message_queue context key posts them at its end. """
+        queue = self.env.context.get('payslip_message_queue')
+        if queue is not None:
+            queue.extend(payments)
         else:
-            self.reconciled = False
+            self._post_payment_messages(payments)
+
+    @api.model
+    def _post_payment_messages(self, payments):
+        """ Post the messages of the given payments, queuing their emails instead of sending them: one message per
+        payslip, or one summary per batch for the companies asking for it. """
+        if not payments:
+            return
+        with get_profiler(self.env).phase('chatter', len(payments)):
+            payments_by_run = defaultdict(list)
+            for payslip, payment, amount, currency in payments:
+                if payslip.company_id.payslip_payment_summary and payslip.payslip_run_id:
+                    payments_by_run[payslip.payslip_run_id.id].append((payslip, payment, amount, currency))
+                    continue
+                payslip.with_context(mail_notify_force_send=False).message_post(
+                    body=payslip._get_payment_message(payment, amount=amount, currency=currency))
+            PayslipRun = self.env['hr.payslip.run'].with_context(mail_notify_force_send=False)
+            for run_id, run_payments in payments_by_run.items():
+                run = PayslipRun.browse(run_id)
+                run.message_post(body=run._get_payment_summary_message(run_payments))
+
+    @api.multi
+    def _reconcile_payments(self):
+        """ Reconcile the payable entries of the payslips with the ones of their payments and transfers, using a single
+        reconcile per employee and account instead of one per payment. """
+        with get_profiler(self.env).phase('reconcile', len(self)):
+            lines_by_partner = defaultdict(set)
+            for payslip in self:
+                partner = payslip.employee_id.address_home_id
+                payments = payslip.payment_ids | payslip.grouped_payment_ids
+                for line in payslip._get_move_lines() | payments.mapped('move_line_ids') | \
+                        payslip._get_transfer_lines():
+                    if line.account_id.internal_type == 'payable' and not line.reconciled:
+                        lines_by_partner[(partner.id, line.account_id.id)].add(line.id)
+            AccountMoveLine = self.env['account.move.line'].with_context(payslip_defer_paid_state=True)
+            for line_ids in lines_by_partner.values():
+                if len(line_ids) > 1:
+                    AccountMoveLine.browse(list(line_ids)).reconcile()
+        self._set_paid_if_reconciled()
+        self.env['hr.payslip.liability']._refresh(self)
+
+    @api.multi
+    def _set_paid_if_reconciled(self):
+        """ Set the reconciled payslips to paid with a single write, then check the state of their batches. """
+        payslips = self.filtered(lambda payslip: payslip.reconciled and payslip.state != 'paid')
+        if payslips:
+            with get_profiler(self.env).phase('paid state', len(payslips)):
+                payslips.write({'state': 'paid'})
+                payslips.mapped('payslip_run_id')._check_paid_state()
+
+    @api.multi
+    def _filter_unpaid(self):
+        """ Return the payslips without any posted payment or salary transfer, so that a payment run can be
+        resumed without paying anyone twice. """
+        if not self:
+            return self
+        groups = self.env['account.payment'].read_group(
+            [('payslip_id', 'in', self.ids), ('state', 'in', ('posted', 'sent', 'reconciled'))],
+            ['payslip_id'], ['payslip_id'])
+        groups += self.env['account.move.line'].read_group(
+            [('payslip_id', 'in', self.ids), ('move_id.state', '=', 'posted'),
+             ('journal_id.type', 'in', ('bank', 'cash'))],
+            ['payslip_id'], ['payslip_id'])
+        paid_ids = set(group['payslip_id'][0] for group in groups)
+        paid_ids.update(self.env['account.payment'].search([
+            ('payslip_ids', 'in', self.ids), ('state', 'in', ('posted', 'sent', 'reconciled')),
+        ]).mapped('payslip_ids').ids)
+        return self.filtered(lambda payslip: payslip.id not in paid_ids)
 
     @api.multi
     def set_to_paid(self):
-        if self.state not in 'paid':
-            self.write({'state': 'paid'})
+        payslips = self.filtered(lambda payslip: payslip.state != 'paid')
+        if payslips:
+            payslips.write({'state': 'paid'})
+            self.env['hr.payslip.liability']._refresh(payslips)
 
     @api.multi
     def set_to_draft(self):
-        if self.state not in 'draft':
-            self.write({'state': 'draft'})
+        payslips = self.filtered(lambda payslip: payslip.state != 'draft')
+        if payslips:
+            payslips.write({'state': 'draft'})
+            self.env['hr.payslip.liability']._refresh(payslips)
+
+    @api.multi
+    def action_payslip_done(self):
+        res = super(HrPayslip, self).action_payslip_done()
+        self.env['hr.payslip.liability']._refresh(self)
+        return res
+
+    def _prepare_grouped_move_vals(self, journal, date, run):
+        """ Return the values of the journal entry shared by the payslips. The items on a partner or on a
+        reconcilable account are kept per payslip and tagged with it, the other ones are summed per account. """
+        precision = self.env['decimal.precision'].precision_get('Payroll')
+        currency = journal.company_id.currency_id
+        line_values = []
+        summed_values = OrderedDict()
+        total = 0.0
+        for slip in self:
+            for line in slip.details_by_salary_rule_category:
+                amount = slip.credit_note and -line.total or line.total
+                if float_is_zero(amount, precision_digits=precision):
+                    continue
+                rule = line.salary_rule_id
+                for account, credit_account in ((rule.account_debit, False), (rule.account_credit, True)):
+                    if not account:
+                        continue
+                    balance = currency.round(credit_account and -amount or amount)
+                    total += balance
+                    values = {
+                        'name': line.name,
+                        'partner_id': line._get_partner_id(credit_account=credit_account),
+                        'account_id': account.id,
+                        'journal_id': journal.id,
+                        'date': date,
+                        'analytic_account_id': rule.analytic_account_id.id,
+                        'tax_line_id': rule.account_tax_id.id,
+                    }
+                    if values['partner_id'] or account.reconcile:
+                        values.update(payslip_id=slip.id, balance=balance)
+                        line_values.append(values)
+                    else:
+                        key = (account.id, values['analytic_account_id'], values['tax_line_id'], line.name)
+                        summed_values.setdefault(key, dict(values, balance=0.0))['balance'] += balance
+        line_values.extend(summed_values.values())
+
+        if float_compare(total, 0.0, precision_rounding=currency.rounding):
+            account = total > 0.0 and journal.default_credit_account_id or journal.default_debit_account_id
+            if not account:
+                raise UserError(_('The Expense Journal "%s" has not properly configured the %s Account!') % (
+                    journal.name, total > 0.0 and _('Credit') or _('Debit')))
+            line_values.append({
+                'name': _('Adjustment Entry'),
+                'account_id': account.id,
+                'journal_id': journal.id,
+                'date': date,
+                'balance': -total,
+            })
+
+        lines = []
+        for values in line_values:
+            balance = values.pop('balance')
+            if float_is_zero(balance, precision_rounding=currency.rounding):
+                continue
+            values.update(debit=balance > 0.0 and balance or 0.0, credit=balance < 0.0 and -balance or 0.0)
+            lines.append((0, 0, values))
+        name = run and _('Payslips of %s') % run.name or _('Payslips of %s') % date
+        return {
+            'narration': name,
+            'ref': run and run.name or name,
+            'journal_id': journal.id,
+            'date': date,
+            'line_ids': lines,
+        }
+
+    @api.multi
+    def _action_payslip_done_grouped(self, grouping='run'):
+        """ Confirm the payslips with a journal entry per batch ('run'), or per journal and date
+        ('journal_date'), instead of one per payslip. """
+        self.compute_sheet()
+        self.write({'state': 'done'})
+
+        PayslipRun = self.env['hr.payslip.run']
+        slip_ids_by_move = OrderedDict()
+        for slip in self:
+            if grouping == 'run' and slip.payslip_run_id:
+                key = (slip.journal_id, slip.payslip_run_id.date_end, slip.payslip_run_id)
+            else:
+                key = (slip.journal_id, slip.date or slip.date_to, PayslipRun)
+            slip_ids_by_move.setdefault(key, []).append(slip.id)
+
+        Move = self.env['account.move'].with_context(check_move_validity=False)
+        moves = Move
+        with get_profiler(self.env).phase('grouped journal entries', len(self)):
+            for (journal, date, run), slip_ids in slip_ids_by_move.items():
+                slips = self.browse(slip_ids)
+                move = Move.create(slips._prepare_grouped_move_vals(journal, date, run))
+                slips.write({'move_id': move.id, 'date': date})
+                moves |= move
+            moves.post()
+        self.env['hr.payslip.liability']._refresh(self)
+        return True
 
     @api.model
     def get_contract(self, employee, date_from, date_to):
@@ -153,7 +469,8 @@ class HrPayslip(models.Model):
 
 
 class HrPayslipRun(models.Model):
-    _inherit = 'hr.payslip.run'
+    _name = 'hr.payslip.run'
+    _inherit = ['hr.payslip.run', 'mail.thread']
 
     state = fields.Selection([
         ('draft', _('Draft')),
@@ -161,45 +478,195 @@ class HrPayslipRun(models.Model):
         ('paid', _('Paid')),
         ('close', _('Close')),
     ], string=_('Status'), index=True, readonly=True, copy=False, default='draft')
-    total_amount = fields.Float(string=_('Total Amount'), compute='_compute_total_amount')
+    total_amount = fields.Float(string=_('Total Amount'), compute='_compute_aggregates', store=True)
+    total_paid = fields.Float(string=_('Total Paid'), compute='_compute_aggregates', store=True)
+    total_residual = fields.Float(string=_('Total Due'), compute='_compute_aggregates', store=True)
+    slip_count = fields.Integer(string=_('Payslips'), compute='_compute_aggregates', store=True)
+    paid_slip_count = fields.Integer(string=_('Paid Payslips'), compute='_compute_aggregates', store=True)
+    paid_progress = fields.Float(string=_('Paid'), compute='_compute_paid_progress')
+    move_grouping = fields.Selection([
+        ('payslip', _('One Entry per Payslip')),
+        ('run', _('One Entry per Batch')),
+        ('journal_date', _('One Entry per Journal and Date')),
+    ], string=_('Journal Entries'), required=True, default='payslip',
+        help="Journal entries made when the payslips of the batch are confirmed. The shared entries keep one payable "
+             "item per payslip and sum the other items per account.")
+    job_ids = fields.One2many('hr.payslip.run.job', 'payslip_run_id', string=_('Jobs'))
+    payment_profile = fields.Text(string=_('Last Profile'), readonly=True, copy=False,
+                                  help="Timings and query counts per phase of the last profiled confirmation or payment "
+                                       "of the batch, see the payslip_payment.profiling system parameter.")
+    payment_profile_date = fields.Datetime(string=_('Last Profile Date'), readonly=True, copy=False)
+
+    @api.depends('slip_ids', 'slip_ids.state', 'slip_ids.total_amount', 'slip_ids.residual_company_signed')
+    def _compute_aggregates(self):
+        """ Sum the payslips of all the batches with a single grouped query; the amounts due and paid only
+        account for the confirmed payslips. """
+        aggregates = defaultdict(lambda: dict(total_amount=0.0, total_paid=0.0, total_residual=0.0,
+                                              slip_count=0, paid_slip_count=0))
+        run_ids = [run_id for run_id in self.ids if isinstance(run_id, int)]
+        if run_ids:
+            groups = self.env['hr.payslip'].read_group([('payslip_run_id', 'in', run_ids)],
+                                                       ['payslip_run_id', 'state', 'total_amount',
+                                                        'residual_company_signed'],
+                                                       ['payslip_run_id', 'state'], lazy=False)
+            for group in groups:
+                values = aggregates[group['payslip_run_id'][0]]
+                total_amount = group['total_amount'] or 0.0
+                residual = group['residual_company_signed'] or 0.0
+                values['total_amount'] += total_amount
+                values['slip_count'] += group['__count']
+                if group['state'] in ('done', 'paid'):
+                    values['total_residual'] += residual
+                    values['total_paid'] += total_amount - residual
+                if group['state'] == 'paid':
+                    values['paid_slip_count'] += group['__count']
+        for run in self:
+            if isinstance(run.id, int):
+                values = aggregates[run.id]
+            else:
+                # new records are only in the cache
+                done_slips = run.slip_ids.filtered(lambda slip: slip.state in ('done', 'paid'))
+                values = dict(
+                    total_amount=sum(run.slip_ids.mapped('total_amount')),
+                    total_residual=sum(done_slips.mapped('residual_company_signed')),
+                    total_paid=sum(done_slips.mapped('total_amount')) - sum(
+                        done_slips.mapped('residual_company_signed')),
+                    slip_count=len(run.slip_ids),
+                    paid_slip_count=len(run.slip_ids.filtered(lambda slip: slip.state == 'paid')),
+                )
+            run.update(values)
+
+    @api.depends('slip_count', 'paid_slip_count')
+    def _compute_paid_progress(self):
+        for run in self:
+            run.paid_progress = run.slip_count and 100.0 * run.paid_slip_count / run.slip_count or 0.0
 
     @api.multi
-    def batch_wise_payslip_confirm(self):
-        for record in self.slip_ids:
-            if record.state == 'draft':
+    def _confirm_payslips(self, payslips):
+        """ Confirm the given draft payslips of the batch, with the journal entries asked by the batch """
+        self.ensure_one()
+        if self.move_grouping == 'payslip':
+            # refresh the liabilities of the payslips once, instead of once per payslip
+            queue = set()
+            for record in payslips.with_context(payslip_liability_queue=queue):
                 record.action_payslip_done()
-        self.state = 'done'
+            self.env['hr.payslip.liability']._refresh(payslips.browse(list(queue)))
+        else:
+            payslips._action_payslip_done_grouped(self.move_grouping)
+
+    @api.multi
+    @profiled('batch_wise_payslip_confirm', lambda runs: runs)
+    def batch_wise_payslip_confirm(self):
+        with get_profiler(self.env).phase('confirm payslips', len(self.slip_ids)):
+            for run in self:
+                payslips = run.slip_ids.filtered(lambda slip: slip.state == 'draft')
+                if payslips:
+                    run._confirm_payslips(payslips)
+        self.write({'state': 'done'})
+
+    @api.multi
+    def action_export_bank_file(self):
+        """ Export the salary transfers of the batch to a pain.001 file """
+        self.ensure_one()
+        return self.env['hr.payslip.bank.file']._export(
+            self, 'slip.payslip_run_id = %(run_id)s', 'slip.payslip_run_id = %(run_id)s', {'run_id': self.id},
+            file_format=self.env.context.get('bank_file_format', 'pain001'))
+
+    @api.multi
+    def action_enqueue_confirm(self):
+        """ Confirm the payslips in the background: the batch is moved to 'done' by the job once it is finished """
+        for run in self:
+            self.env['hr.payslip.run.job'].create({'payslip_run_id': run.id, 'job_type': 'confirm'})
+        return True
+
+    @api.multi
+    def _get_payment_summary_message(self, payments):
+        """ Return the chatter message summing up the payments of payslips of the batch, given as (payslip, payment,
+        amount, currency) tuples. """
+        totals = defaultdict(float)
+        for payslip, payment, amount, currency in payments:
+            totals[currency] += amount
+        body = _("%d payslips have been paid for a total of %s.") % (
+            len(payments), ', '.join('%.2f %s' % (amount, currency.symbol) for currency, amount in totals.items()))
+        return body + '<ul>%s</ul>' % ''.join(
+            "<li>%s: <a href='/mail/view?%s'>%s</a></li>" % (
+                html_escape(payslip.name), url_encode({'model': payment._name, 'res_id': payment.id}),
+                html_escape(payment.name))
+            for payslip, payment, amount, currency in payments)
+
+    @api.multi
+    def _check_paid_state(self):
+        """ Set the batches whose payslips are all paid to 'paid', from their payslip counters. """
+        paid_runs = self.filtered(
+            lambda run: run.state != 'paid' and run.paid_slip_count and run.paid_slip_count == run.slip_count)
+        if paid_runs:
+            paid_runs.write({'state': 'paid'})
 
 
 class AccountMoveLine(models.Model):
     _inherit = "account.move.line"
 
-    payslip_id = fields.Many2one('hr.payslip', string=_('Payslip'), copy=False,
+    payslip_id = fields.Many2one('hr.payslip', string=_('Payslip'), copy=False, index=True,
                                  help='Payslip where the move line come from')
 
+    def _get_payslips(self):
+        """ Return the payslips of the journal items: the payslips of their payments, the payslips they are tagged
+        with, and the payslips of the journal entries of the untagged payable items. """
+        payslips = self.mapped('payment_id.payslip_id') | self.mapped('payment_id.payslip_ids') | \
+            self.mapped('payslip_id')
+        moves = self.filtered(
+            lambda line: not line.payslip_id and not line.payment_id and line.account_id.internal_type == 'payable'
+        ).mapped('move_id')
+        if moves:
+            payslips |= self.env['hr.payslip'].search([('move_id', 'in', moves.ids)])
+        return payslips
+
     @api.multi
     def reconcile(self, writeoff_acc_id=False, writeoff_journal_id=False):
         res = super(AccountMoveLine, self).reconcile(writeoff_acc_id=writeoff_acc_id,
                                                      writeoff_journal_id=writeoff_journal_id)
-        for rec in self:
-            if rec.payment_id.payslip_id and rec.payment_id.payslip_id.reconciled:
-                rec.payment_id.payslip_id.set_to_paid()
+        if not self.env.context.get('payslip_defer_paid_state'):
+            payslips = self._get_payslips()
+            payslips._set_paid_if_reconciled()
+            self.env['hr.payslip.liability']._refresh(payslips)
+        return res
+
+    @api.multi
+    def remove_move_reconcile(self):
+        payslips = self._get_payslips()
+        res = super(AccountMoveLine, self).remove_move_reconcile()
+        self.env['hr.payslip.liability']._refresh(payslips)
         return res
 
 
 class AccountPayment(models.Model):
     _inherit = "account.payment"
 
-    payslip_id = fields.Many2one('hr.payslip', string=_('Payslip'), copy=False,
+    payslip_id = fields.Many2one('hr.payslip', string=_('Payslip'), copy=False, index=True,
                                  help='Payslip where the payment come from')
+    payslip_ids = fields.Many2many('hr.payslip', 'account_payment_hr_payslip_rel', 'account_payment_id',
+                                   'hr_payslip_id', string=_('Payslips'), copy=False,
+                                   help='Payslips of the employee paid at once by the payment')
 
     def _compute_destination_account_id(self):
         destination_account_id = self._context.get('destination_account_id', False)
         if destination_account_id:
-            self.destination_account_id = destination_account_id
+            # the payments of a group are computed at once
+            for payment in self:
+                payment.destination_account_id = destination_account_id
             return
         super(AccountPayment, self)._compute_destination_account_id()
 
+    @api.multi
+    def action_export_bank_file(self):
+        """ Export the selected payslip payments to a pain.001 file attached to their journal """
+        journal = self.mapped('journal_id')
+        if len(journal) != 1:
+            raise ValidationError(_('The payments to export must be paid from the same journal.'))
+        return self.env['hr.payslip.bank.file']._export(
+            journal, 'payment.id IN %(payment_ids)s', 'FALSE', {'payment_ids': tuple(self.ids)},
+            file_format=self.env.context.get('bank_file_format', 'pain001'))
+
     @api.multi
     def button_payslips(self):
         return {
@@ -209,62 +676,78 @@ class AccountPayment(models.Model):
             'res_model': 'hr.payslip',
             'view_id': False,
             'type': 'ir.actions.act_window',
-            'domain': [('id', 'in', [self.payslip_id.id])],
+            'domain': [('id', 'in', (self.payslip_id | self.payslip_ids).ids)],
         }
 
     @api.multi
     def cancel(self):
         super(AccountPayment, self).cancel()
         for rec in self:
-            if rec.payslip_id and rec.payslip_id.state == 'paid':
-                rec.payslip_id.state = 'done'
+            paid_payslips = (rec.payslip_id | rec.payslip_ids).filtered(lambda payslip: payslip.state == 'paid')
+            if paid_payslips:
+                paid_payslips.write({'state': 'done'})
+        self.env['hr.payslip.liability']._refresh(self.mapped('payslip_id') | self.mapped('payslip_ids'))
+
+    def _get_payslip_shares(self, residuals):
+        """ Return the (payslip, amount) shares of the payment. The payment of several payslips is split along the
+        given residuals of the payslips, the last payslip taking the rounding difference. """
+        self.ensure_one()
+        if self.payslip_id:
+            return [(self.payslip_id, self.amount)]
+        payslips = self.payslip_ids
+        total = sum(residuals.get(payslip.id, 0.0) for payslip in payslips)
+        shares = []
+        amount_left = self.amount
+        for payslip in payslips[:-1]:
+            amount = total and self.currency_id.round(self.amount * residuals.get(payslip.id, 0.0) / total) or 0.0
+            shares.append((payslip, amount))
+            amount_left -= amount
+        shares.append((payslips[-1], self.currency_id.round(amount_left)))
+        return shares
 
     @api.multi
+    @profiled('account_payment_post', lambda payments: payments.mapped('payslip_id.payslip_run_id'))
     def post(self):
-        self.ensure_one()
-
-        destination_account_id = None
-        payment = None
-        payslip = None
-
-        if 'destination_account_id' not in self.env.context:
-            for rec in self:
-                if rec.payslip_id and rec.payslip_id.state != 'done':
-                    raise ValidationError(_("The payment cannot be processed because the payslip is not confirmed!"))
-                payslip = rec.payslip_id
-                payment = rec
-                destination_account_id = payslip.employee_id.address_home_id.property_account_payable_id
-                if payslip.move_id:
-                    for line in payslip.move_id.line_ids:
-                        if line.credit:
-                            destination_account_id = line.account_id
-
-        if destination_account_id:
-            context = dict(self.env.context)
-            context['destination_account_id'] = destination_account_id
-            super(AccountPayment, self).with_context(context).post()
-        else:
-            super(AccountPayment, self).post()
-
-        if payment and payslip:
-            body = (_(
-                "A payment of %s %s with the reference <a href='/mail/view?%s'>%s</a> related to your expense %s has been made.") % (
-                        payment.amount, payment.currency_id.symbol,
-                        url_encode({'model': 'account.payment', 'res_id': payment.id}), payment.name, payslip.name))
-            payslip.message_post(body=body)
-
-            if payslip.reconciled:
-                # Reconcile the payment, i.e. lookup on the payable account move lines
-                account_move_lines_to_reconcile = self.env['account.move.line']
-
-                for line in payment.move_line_ids + payslip.move_id.line_ids:
-                    if line.account_id.internal_type == 'payable':
-                        account_move_lines_to_reconcile |= line
-                account_move_lines_to_reconcile.reconcile()
-
-            if payslip.payslip_run_id:
-                payslip_paid_search = self.env['hr.payslip'].search(
-                    [('payslip_run_id', '=', payslip.payslip_run_id.id), ('state', '=', 'paid')])
-                if payslip_paid_search:
-                    if len(payslip.payslip_run_id.slip_ids) == len(payslip_paid_search):
-                        payslip.payslip_run_id.write({'state': 'paid'})
+        if 'destination_account_id' in self.env.context:
+            return super(AccountPayment, self).post()
+
+        payslip_payments = self.filtered(lambda payment: payment.payslip_id or payment.payslip_ids)
+        payslips = payslip_payments.mapped('payslip_id') | payslip_payments.mapped('payslip_ids')
+        if any(payslip.state != 'done' for payslip in payslips):
+            raise ValidationError(_("The payment cannot be processed because the payslip is not confirmed!"))
+
+        other_payments = self - payslip_payments
+        if other_payments:
+            super(AccountPayment, other_payments).post()
+        if not payslip_payments:
+            return True
+
+        # the residuals splitting the payments of several payslips, read before they are paid
+        residuals = {payslip.id: abs(payslip.residual_company_signed)
+                     for payslip in payslip_payments.mapped('payslip_ids')}
+
+        # Post the payments sharing the same destination account together
+        profiler = get_profiler(self.env)
+        with profiler.phase('destination accounts', len(payslips)):
+            destination_accounts = payslips._get_destination_accounts()
+        payments_by_account = defaultdict(list)
+        for payment in payslip_payments:
+            payslip = payment.payslip_id or payment.payslip_ids[0]
+            payments_by_account[destination_accounts[payslip.id]].append(payment.id)
+        with profiler.phase('post payments', len(payslip_payments)):
+            for destination_account_id, payment_ids in payments_by_account.items():
+                super(AccountPayment, self.browse(payment_ids).with_context(
+                    destination_account_id=destination_account_id)).post()
+
+        # Reconcile the payments, i.e. lookup on the payable account move lines. The residual of a payslip paid
+        # along with others does not account for the payment until it is reconciled.
+        queue = set()
+        (payslips.filtered('reconciled') | payslip_payments.mapped('payslip_ids')).with_context(
+            payslip_liability_queue=queue)._reconcile_payments()
+        payslips.mapped('payslip_run_id')._check_paid_state()
+
+        self.env['hr.payslip']._log_payments([(payslip, payment, amount, payment.currency_id)
+                                              for payment in payslip_payments
+                                              for payslip, amount in payment._get_payslip_shares(residuals)])
+        self.env['hr.payslip.liability']._refresh(payslips | payslips.browse(list(queue)))
+        return True
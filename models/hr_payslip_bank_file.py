@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import base64
+import csv
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+FETCH_SIZE = 2000
+COPY_SIZE = 1 << 16
+
+CSV_HEADER = ['reference', 'date', 'name', 'iban', 'bic', 'amount', 'currency', 'communication']
+
+
+class HrPayslipBankFile(models.AbstractModel):
+    """ Streaming export of salary bank transfers. The transfers are read from a server-side cursor in chunks and
+    written one by one to a temporary file, which is then moved to the filestore, so that memory stays flat
+    whatever the number of payments. """
+    _name = 'hr.payslip.bank.file'
+    _description = 'Salary Bank Transfer File'
+
+    def _get_transfer_query(self, payment_where, transfer_where):
+        """ Return the query of the bank transfers: the posted payslip payments and the lines of the single salary
+        transfers matching the given conditions, ordered by date. The payments of several payslips of an employee
+        are matched through the first of them. The lines of the transfers in foreign currency give their amount in
+        that currency. The lines of credit notes, which are not transfers to the employee, are left out. """
+        return """
+            SELECT transfer.*
+              FROM (SELECT payment.name AS reference, payment.payment_date AS date, partner.name AS name,
+                           bank.acc_number AS iban, res_bank.bic AS bic, payment.amount AS amount,
+                           currency.name AS currency, COALESCE(payment.communication, slip.number) AS communication
+                      FROM account_payment payment
+                      JOIN hr_payslip slip ON slip.id = COALESCE(payment.payslip_id, (
+                               SELECT MIN(rel.hr_payslip_id) FROM account_payment_hr_payslip_rel rel
+                                WHERE rel.account_payment_id = payment.id))
+                      JOIN hr_employee employee ON employee.id = slip.employee_id
+                      JOIN res_partner partner ON partner.id = payment.partner_id
+                      JOIN res_currency currency ON currency.id = payment.currency_id
+                 LEFT JOIN res_partner_bank bank ON bank.id = employee.bank_account_id
+                 LEFT JOIN res_bank ON res_bank.id = bank.bank_id
+                     WHERE payment.state IN ('posted', 'sent', 'reconciled') AND {payment_where}
+                 UNION ALL
+                    SELECT move.name AS reference, move.date AS date, partner.name AS name,
+                           bank.acc_number AS iban, res_bank.bic AS bic,
+                           CASE WHEN aml.currency_id IS NOT NULL THEN aml.amount_currency
+                                ELSE aml.debit - aml.credit END AS amount,
+                           currency.name AS currency, COALESCE(move.ref, slip.number) AS communication
+                      FROM account_move_line aml
+                      JOIN account_move move ON move.id = aml.move_id
+                      JOIN account_journal journal ON journal.id = move.journal_id
+                      JOIN hr_payslip slip ON slip.id = aml.payslip_id
+                      JOIN hr_employee employee ON employee.id = slip.employee_id
+                      JOIN res_partner partner ON partner.id = aml.partner_id
+                      JOIN res_company company ON company.id = move.company_id
+                      JOIN res_currency currency ON currency.id = COALESCE(aml.currency_id, company.currency_id)
+                 LEFT JOIN res_partner_bank bank ON bank.id = employee.bank_account_id
+                 LEFT JOIN res_bank ON res_bank.id = bank.bank_id
+                     WHERE move.state = 'posted' AND journal.type IN ('bank', 'cash')
+                       AND aml.payment_id IS NULL AND aml.move_id IS DISTINCT FROM slip.move_id
+                       AND {transfer_where}) transfer
+             WHERE transfer.amount > 0
+          ORDER BY transfer.date, transfer.reference
+        """.format(payment_where=payment_where, transfer_where=transfer_where)
+
+    def _iter_transfers(self, query, params):
+        """ Yield the transfers as dictionaries, fetched in chunks from a server-side cursor. """
+        with self.env.cr._cnx.cursor('payslip_bank_file') as cursor:
+            cursor.itersize = FETCH_SIZE
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(CSV_HEADER, row))
+
+    def _get_totals(self, query, params):
+        """ Return the number and the sum of the transfers per date, as needed by the headers of the file. """
+        self.env.cr.execute("""
+            SELECT date, COUNT(*), SUM(amount) FROM ({query}) transfer GROUP BY date ORDER BY date
+        """.format(query=query), params)
+        return [(date, count, amount or 0.0) for date, count, amount in self.env.cr.fetchall()]
+
+    def _write_csv(self, fileobj, transfers, totals, journal):
+        writer_file = io.TextIOWrapper(fileobj, encoding='utf-8', newline='')
+        writer = csv.writer(writer_file, delimiter=';')
+        writer.writerow(CSV_HEADER)
+        for transfer in transfers:
+            writer.writerow([transfer['reference'], transfer['date'], transfer['name'], transfer['iban'] or '',
+                             transfer['bic'] or '', '%.2f' % transfer['amount'], transfer['currency'],
+                             transfer['communication'] or ''])
+        writer_file.flush()
+        writer_file.detach()
+
+    def _write_pain001(self, fileobj, transfers, totals, journal):
+        """ Write a pain.001.001.03 credit transfer initiation, with one payment information block per date. """
+        def write(text):
+            fileobj.write(text.encode('utf-8'))
+
+        def text(value):
+            return escape(value or '')
+
+        def agent(bic):
+            # the agent of an account without BIC is identified as not provided, as allowed by the SEPA rules
+            if bic:
+                return '<FinInstnId><BIC>%s</BIC></FinInstnId>' % text(bic)
+            return '<FinInstnId><Othr><Id>NOTPROVIDED</Id></Othr></FinInstnId>'
+
+        company = journal.company_id
+        message_id = '%s-%s' % (journal.code, fields.Datetime.now().replace(' ', 'T').replace(':', ''))
+        count = sum(total[1] for total in totals)
+        amount = sum(total[2] for total in totals)
+        write('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<Document xmlns="urn:iso:std:iso:20022:tech:xsd:pain.001.001.03" '
+              'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+              '<CstmrCdtTrfInitn>\n'
+              '<GrpHdr><MsgId>%s</MsgId><CreDtTm>%s</CreDtTm><NbOfTxs>%d</NbOfTxs><CtrlSum>%.2f</CtrlSum>'
+              '<InitgPty><Nm>%s</Nm></InitgPty></GrpHdr>\n' % (
+                  text(message_id[:35]), fields.Datetime.now().replace(' ', 'T'), count, amount,
+                  text(company.name)))
+        totals_by_date = {date: (date_count, date_amount) for date, date_count, date_amount in totals}
+        current_date = None
+        for transfer in transfers:
+            if transfer['date'] != current_date:
+                if current_date:
+                    write('</PmtInf>\n')
+                current_date = transfer['date']
+                date_count, date_amount = totals_by_date[current_date]
+                write('<PmtInf><PmtInfId>%s</PmtInfId><PmtMtd>TRF</PmtMtd><BtchBookg>true</BtchBookg>'
+                      '<NbOfTxs>%d</NbOfTxs><CtrlSum>%.2f</CtrlSum>'
+                      '<PmtTpInf><CtgyPurp><Cd>SALA</Cd></CtgyPurp></PmtTpInf>'
+                      '<ReqdExctnDt>%s</ReqdExctnDt><Dbtr><Nm>%s</Nm></Dbtr>'
+                      '<DbtrAcct><Id><IBAN>%s</IBAN></Id></DbtrAcct>'
+                      '<DbtrAgt>%s</DbtrAgt><ChrgBr>SLEV</ChrgBr>\n' % (
+                          text(('%s-%s' % (message_id, current_date))[:35]), date_count, date_amount,
+                          current_date, text(company.name), text(journal.bank_acc_number).replace(' ', ''),
+                          agent(journal.bank_id.bic)))
+            write('<CdtTrfTxInf><PmtId><EndToEndId>%s</EndToEndId></PmtId>'
+                  '<Amt><InstdAmt Ccy=%s>%.2f</InstdAmt></Amt>'
+                  '%s<Cdtr><Nm>%s</Nm></Cdtr>'
+                  '<CdtrAcct><Id><IBAN>%s</IBAN></Id></CdtrAcct>'
+                  '<RmtInf><Ustrd>%s</Ustrd></RmtInf></CdtTrfTxInf>\n' % (
+                      text((transfer['reference'] or '')[:35]), quoteattr(transfer['currency']), transfer['amount'],
+                      transfer['bic'] and '<CdtrAgt>%s</CdtrAgt>' % agent(transfer['bic']) or '',
+                      text((transfer['name'] or '')[:70]), text(transfer['iban']).replace(' ', ''),
+                      text((transfer['communication'] or '')[:140])))
+        if current_date:
+            write('</PmtInf>\n')
+        write('</CstmrCdtTrfInitn>\n</Document>\n')
+
+    def _attach_file(self, fileobj, filename, mimetype, record):
+        """ Store the file as an attachment of the record, streaming it to the filestore. """
+        Attachment = self.env['ir.attachment']
+        values = {
+            'name': filename,
+            'datas_fname': filename,
+            'res_model': record._name,
+            'res_id': record.id,
+            'type': 'binary',
+            'mimetype': mimetype,
+        }
+        fileobj.seek(0)
+        if Attachment._storage() == 'db':
+            # the database storage needs the whole content at once
+            values['datas'] = base64.b64encode(fileobj.read())
+            return Attachment.create(values)
+
+        checksum = hashlib.sha1()
+        file_size = 0
+        for data in iter(lambda: fileobj.read(COPY_SIZE), b''):
+            checksum.update(data)
+            file_size += len(data)
+        checksum = checksum.hexdigest()
+        fname, full_path = Attachment._get_path(None, checksum)
+        if not os.path.exists(full_path):
+            fileobj.seek(0)
+            with open(full_path, 'wb') as target:
+                shutil.copyfileobj(fileobj, target, COPY_SIZE)
+            Attachment._mark_for_gc(fname)
+        values['store_fname'] = fname
+        attachment = Attachment.create(values)
+        # file_size and checksum are computed from the content on create, which is not given here
+        self.env.cr.execute("UPDATE ir_attachment SET file_size = %s, checksum = %s WHERE id = %s",
+                            (file_size, checksum, attachment.id))
+        attachment.invalidate_cache(['file_size', 'checksum'], attachment.ids)
+        return attachment
+
+    @api.model
+    def _get_journal(self, payment_where, transfer_where, params):
+        """ Return the journal the transfers are paid from, a bank file being issued for a single account. """
+        self.env.cr.execute("""
+            SELECT payment.journal_id
+              FROM account_payment payment
+              JOIN hr_payslip slip ON slip.id = COALESCE(payment.payslip_id, (
+                   SELECT MIN(rel.hr_payslip_id) FROM account_payment_hr_payslip_rel rel
+                    WHERE rel.account_payment_id = payment.id))
+             WHERE payment.state IN ('posted', 'sent', 'reconciled') AND {payment_where}
+             UNION
+            SELECT aml.journal_id
+              FROM account_move_line aml
+              JOIN account_journal journal ON journal.id = aml.journal_id
+              JOIN hr_payslip slip ON slip.id = aml.payslip_id
+             WHERE journal.type IN ('bank', 'cash') AND aml.payment_id IS NULL
+               AND aml.move_id IS DISTINCT FROM slip.move_id AND {transfer_where}
+        """.format(payment_where=payment_where, transfer_where=transfer_where), params)
+        journal_ids = [row[0] for row in self.env.cr.fetchall()]
+        if len(journal_ids) > 1:
+            raise UserError(_('The payments to export must be paid from the same journal.'))
+        return self.env['account.journal'].browse(journal_ids)
+
+    @api.model
+    def _export(self, record, payment_where, transfer_where, params, file_format='pain001'):
+        """ Export the bank transfers matching the conditions to a file attached to the record and return the
+        action downloading it. """
+        journal = self._get_journal(payment_where, transfer_where, params)
+        query = self._get_transfer_query(payment_where, transfer_where)
+        totals = self._get_totals(query, params)
+        if not totals:
+            raise UserError(_('There is no posted payment to export.'))
+        if file_format == 'csv':
+            writer, extension, mimetype = self._write_csv, 'csv', 'text/csv'
+        else:
+            if not journal.bank_acc_number:
+                raise UserError(_('Please define the bank account of the journal %s.') % journal.name)
+            writer, extension, mimetype = self._write_pain001, 'xml', 'application/xml'
+        filename = '%s.%s' % (record.display_name.replace('/', '_'), extension)
+        with tempfile.TemporaryFile() as fileobj:
+            writer(fileobj, self._iter_transfers(query, params), totals, journal)
+            attachment = self._attach_file(fileobj, filename, mimetype, record)
+        _logger.info("Exported %d bank transfers of %s to %s", sum(total[1] for total in totals),
+                     record.display_name, filename)
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/web/content/%s?download=true' % attachment.id,
+            'target': 'self',
+        }
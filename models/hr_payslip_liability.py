@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+AGE_BUCKETS = [
+    ('0_30', '0-30 Days'),
+    ('31_60', '31-60 Days'),
+    ('61_90', '61-90 Days'),
+    ('91_180', '91-180 Days'),
+    ('older', 'Older'),
+]
+
+AGE_BUCKET_SQL = """
+    CASE WHEN %(today)s::date - {date} <= 30 THEN '0_30'
+         WHEN %(today)s::date - {date} <= 60 THEN '31_60'
+         WHEN %(today)s::date - {date} <= 90 THEN '61_90'
+         WHEN %(today)s::date - {date} <= 180 THEN '91_180'
+         ELSE 'older' END
+"""
+
+
+class HrPayslipLiability(models.Model):
+    """ Ledger of the open salary liabilities: one row per confirmed payslip with an amount due, written with plain
+    SQL from the stored residuals of the payslips. The rows are refreshed by the payment, cancel and reconcile hooks
+    for the payslips they touch, so that aging reports never scan the payslips nor their journal items. """
+    _name = 'hr.payslip.liability'
+    _description = 'Open Salary Liability'
+    _log_access = False
+    _order = 'date, payslip_id'
+    _rec_name = 'payslip_id'
+
+    payslip_id = fields.Many2one('hr.payslip', string='Payslip', required=True, readonly=True, index=True,
+                                 ondelete='cascade')
+    employee_id = fields.Many2one('hr.employee', string='Employee', readonly=True, index=True)
+    payslip_run_id = fields.Many2one('hr.payslip.run', string='Batch', readonly=True, index=True)
+    company_id = fields.Many2one('res.company', string='Company', readonly=True, index=True)
+    company_currency_id = fields.Many2one('res.currency', string='Company Currency', readonly=True)
+    currency_id = fields.Many2one('res.currency', string='Currency', readonly=True, index=True)
+    date = fields.Date(string='Date', readonly=True, index=True)
+    age_bucket = fields.Selection(AGE_BUCKETS, string='Age', readonly=True, index=True)
+    amount_residual = fields.Monetary(string='Amount Due', readonly=True, currency_field='company_currency_id')
+    amount_residual_currency = fields.Monetary(string='Amount Due in Currency', readonly=True,
+                                               currency_field='currency_id')
+
+    _sql_constraints = [
+        ('payslip_uniq', 'unique(payslip_id)', 'A payslip has a single open liability.'),
+    ]
+
+    def _insert(self, where, params, residuals=None):
+        """ Insert the liabilities of the payslips matching `where`, from their stored residuals or from the given
+        (payslip id, reconciled, residual in company currency, residual in currency) tuples. """
+        params = dict(params, today=fields.Date.context_today(self))
+        source, join = 'slip', ''
+        if residuals is not None:
+            if not residuals:
+                return 0
+            source = 'residual'
+            join = """
+              JOIN (VALUES {values}) AS residual (payslip_id, reconciled, residual_company_signed, residual_signed)
+                ON residual.payslip_id = slip.id""".format(values=', '.join(
+                self.env.cr.mogrify('(%s, %s, %s::numeric, %s::numeric)', row).decode('utf-8')
+                for row in residuals))
+        self.env.cr.execute("""
+            INSERT INTO hr_payslip_liability (payslip_id, employee_id, payslip_run_id, company_id,
+                                              company_currency_id, currency_id, date, age_bucket, amount_residual,
+                                              amount_residual_currency)
+            SELECT slip.id, slip.employee_id, slip.payslip_run_id, slip.company_id, company.currency_id,
+                   slip.currency_id, COALESCE(slip.date, slip.date_to), {age_bucket},
+                   {source}.residual_company_signed, {source}.residual_signed
+              FROM hr_payslip slip
+              JOIN res_company company ON company.id = slip.company_id {join}
+             WHERE slip.state IN ('done', 'paid') AND {source}.reconciled IS NOT TRUE
+               AND {source}.residual_company_signed != 0 AND {where}
+        """.format(age_bucket=AGE_BUCKET_SQL.format(date='COALESCE(slip.date, slip.date_to)'), source=source,
+                   join=join, where=where), params)
+        return self.env.cr.rowcount
+
+    @api.model
+    def _refresh(self, payslips):
+        """ Refresh the liabilities of the given payslips from their residuals. A flow collecting the payslips in
+        the payslip_liability_queue context key refreshes them once at its end. """
+        payslip_ids = tuple(payslip_id for payslip_id in payslips.ids if isinstance(payslip_id, int))
+        if not payslip_ids:
+            return
+        queue = self.env.context.get('payslip_liability_queue')
+        if queue is not None:
+            queue.update(payslip_ids)
+            return
+        # the residuals are read through the ORM, which computes the pending ones in the cache: the other pending
+        # recomputations are left to the flow, within its norecompute() if any
+        residuals = [(payslip.id, payslip.reconciled, payslip.residual_company_signed, payslip.residual_signed)
+                     for payslip in self.env['hr.payslip'].browse(payslip_ids)]
+        self.env.cr.execute("DELETE FROM hr_payslip_liability WHERE payslip_id IN %s", (payslip_ids,))
+        self._insert('slip.id IN %(payslip_ids)s', {'payslip_ids': payslip_ids}, residuals)
+        self.invalidate_cache()
+
+    @api.model
+    def _rebuild(self):
+        """ Rebuild the whole ledger, e.g. after the module is installed or payslips are changed by hand """
+        self.env['hr.payslip'].recompute()
+        self.env.cr.execute("DELETE FROM hr_payslip_liability")
+        count = self._insert('TRUE', {})
+        self.invalidate_cache()
+        _logger.info("Rebuilt the open salary liabilities: %d payslips with an amount due", count)
+        return True
+
+    @api.model
+    def _cron_update_age_buckets(self):
+        self.env.cr.execute("""
+            UPDATE hr_payslip_liability SET age_bucket = {age_bucket}
+        """.format(age_bucket=AGE_BUCKET_SQL.format(date='date')), {'today': fields.Date.context_today(self)})
+        self.invalidate_cache(['age_bucket'])
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import fields, models, _
+from odoo.exceptions import UserError, ValidationError
+
+from ..profiler import get_profiler
+
+_logger = logging.getLogger(__name__)
+
+
+class HrPayslipPaymentMixin(models.AbstractModel):
+    """ Bulk payment engine shared by the batchwise register payment wizard and the batch jobs: the payments of a
+    set of payslips are built in memory, created together, then posted and reconciled as a single recordset. """
+    _name = 'hr.payslip.payment.mixin'
+    _description = 'Payslip Payment Engine'
+
+    journal_id = fields.Many2one('account.journal', string='Payment Method',
+                                 domain=[('type', 'in', ('bank', 'cash'))])
+    payment_method_id = fields.Many2one('account.payment.method', string='Payment Type')
+    currency_id = fields.Many2one('res.currency', string='Currency',
+                                  default=lambda self: self.env.user.company_id.currency_id)
+    payment_date = fields.Date(string='Payment Date', default=fields.Date.context_today)
+    communication = fields.Char(string='Memo')
+    consolidate = fields.Boolean(string='Single Transfer',
+                                 help="Pay all the payslips with a single journal entry, holding one payable line per "
+                                      "employee, instead of one payment per payslip.")
+
+    def _get_currency_rate(self, from_currency, to_currency, company, date):
+        """ Return the rate converting an amount between two currencies at a date. The rates are kept in the cache
+        of the cursor, so that a pair of currencies is looked up once per transaction, whatever the number of payslips
+        or onchanges. The cursor outlives its transactions, e.g. in the jobs committing every chunk, so the rates are
+        dropped at the end of the transaction. """
+        if from_currency == to_currency:
+            return 1.0
+        date = date or fields.Date.context_today(self)
+        cr = self.env.cr
+        rates = cr.cache.get('payslip_payment_rates')
+        if rates is None:
+            rates = cr.cache['payslip_payment_rates'] = {}
+            cr.after('commit', lambda: cr.cache.pop('payslip_payment_rates', None))
+            cr.after('rollback', lambda: cr.cache.pop('payslip_payment_rates', None))
+        key = (from_currency.id, to_currency.id, company.id, date)
+        if key not in rates:
+            rates[key] = from_currency.with_context(date=date, company_id=company.id).compute(
+                1.0, to_currency, round=False)
+        return rates[key]
+
+    def _convert_amount(self, amount, from_currency, to_currency, company, date):
+        return to_currency.round(amount * self._get_currency_rate(from_currency, to_currency, company, date))
+
+    def _prepare_payment_vals(self, payslip):
+        """ Hook for extension """
+        company = self.journal_id.company_id
+        return {
+            'partner_type': 'supplier',
+            'payment_type': 'outbound',
+            'partner_id': payslip.employee_id.address_home_id.id,
+            'journal_id': self.journal_id.id,
+            'company_id': company.id,
+            'payment_method_id': self.payment_method_id.id,
+            'amount': self._convert_amount(payslip.total_amount, payslip.currency_id, self.currency_id, company,
+                                           self.payment_date),
+            'currency_id': self.currency_id.id,
+            'payment_date': self.payment_date,
+            'communication': self.communication,
+            'writeoff_label': 'Payslip Payment',
+            'payslip_id': payslip.id,
+        }
+
+    def _prepare_payments_vals(self, payslips):
+        """ Return the values of the payments of the payslips, one per payslip by default """
+        return [self._prepare_payment_vals(payslip) for payslip in payslips]
+
+    def _check_payslips(self, payslips):
+        if any(not payslip.employee_id.address_home_id for payslip in payslips):
+            raise ValidationError(_('Please Define Employee Private Address'))
+
+    def _create_payments(self, payslips):
+        """ Create the payments of the payslips from values built beforehand, deferring the recomputation of
+        the computed fields until all of them are created. """
+        profiler = get_profiler(self.env)
+        Payment = self.env['account.payment']
+        with profiler.phase('prepare payments', len(payslips)):
+            payment_values = self._prepare_payments_vals(payslips)
+        payment_ids = []
+        with profiler.phase('create payments', len(payslips)):
+            with self.env.norecompute():
+                for values in payment_values:
+                    payment_ids.append(Payment.create(values).id)
+            Payment.recompute()
+        return Payment.browse(payment_ids)
+
+    def _prepare_transfer_move_vals(self, payslips):
+        """ Hook for extension """
+        destination_accounts = payslips._get_destination_accounts()
+        company = self.journal_id.company_id
+        currency = self.currency_id != company.currency_id and self.currency_id
+        line_values = []
+        total = total_currency = 0.0
+        for payslip in payslips:
+            amount = self._convert_amount(payslip.total_amount, payslip.currency_id, company.currency_id, company,
+                                          self.payment_date)
+            total += amount
+            values = {
+                'name': payslip.number or payslip.name,
+                'partner_id': payslip.employee_id.address_home_id.id,
+                'account_id': destination_accounts[payslip.id].id,
+                'debit': amount > 0.0 and amount or 0.0,
+                'credit': amount < 0.0 and -amount or 0.0,
+                'payslip_id': payslip.id,
+            }
+            if currency:
+                amount_currency = self._convert_amount(payslip.total_amount, payslip.currency_id, currency, company,
+                                                       self.payment_date)
+                total_currency += amount_currency
+                values.update(currency_id=currency.id, amount_currency=amount_currency)
+            line_values.append((0, 0, values))
+        values = {
+            'name': self.communication or _('Salary Transfer'),
+            'account_id': self.journal_id.default_credit_account_id.id,
+            'debit': total < 0.0 and -total or 0.0,
+            'credit': total > 0.0 and total or 0.0,
+        }
+        if currency:
+            values.update(currency_id=currency.id, amount_currency=-total_currency)
+        line_values.append((0, 0, values))
+        return {
+            'journal_id': self.journal_id.id,
+            'date': self.payment_date,
+            'ref': self.communication,
+            'line_ids': line_values,
+        }
+
+    def _create_transfer(self, payslips):
+        """ Pay the payslips with a single journal entry and reconcile every payslip with its own payable line
+        of that entry. """
+        if not self.journal_id.default_credit_account_id:
+            raise UserError(_('Please define a default credit account on the journal %s.') % self.journal_id.name)
+        with get_profiler(self.env).phase('create transfer', len(payslips)):
+            move = self.env['account.move'].create(self._prepare_transfer_move_vals(payslips))
+            move.post()
+
+        payslips.filtered('reconciled')._reconcile_payments()
+
+        self.env['hr.payslip']._log_payments([
+            (line.payslip_id, move, line.debit - line.credit, move.company_id.currency_id)
+            for line in move.line_ids.filtered('payslip_id')])
+        return move
+
+    def _pay_payslips(self, payslips):
+        """ Pay the given confirmed payslips and return the created payments, or the journal entry of the
+        transfer in single transfer mode. The chatter messages of the payments are posted once all of them are
+        paid. """
+        self._check_payslips(payslips)
+        messages = []
+        engine = self.with_context(payslip_message_queue=messages)
+        if self.consolidate:
+            result = engine._create_transfer(payslips)
+        else:
+            result = engine._create_payments(payslips)
+            result.post()
+        self.env['hr.payslip']._post_payment_messages(messages)
+        return result
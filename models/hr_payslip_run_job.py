@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.tools import split_every
+
+from ..profiler import get_profiler, profiled
+
+_logger = logging.getLogger(__name__)
+
+
+class HrPayslipRunJob(models.Model):
+    """ Confirmation or payment of a payslip batch split in chunks, each chunk being committed on its own so that
+    locks are held for a short time only. The job records its progress and can be resumed after an interruption:
+    payslips that already have a posted payment are never paid again.
+
+    Jobs are either run right away, or queued and drained by a cron worker, see `_cron_process_jobs`. A running job
+    without activity for `payslip_payment.job_timeout` minutes is considered as left by a killed worker, and is taken
+    over by the queue. """
+    _name = 'hr.payslip.run.job'
+    _inherit = ['hr.payslip.payment.mixin']
+    _description = 'Payslip Batch Job'
+    _order = 'id desc'
+
+    name = fields.Char(string='Name', compute='_compute_name')
+    payslip_run_id = fields.Many2one('hr.payslip.run', string='Batch Name', required=True, index=True,
+                                     ondelete='cascade')
+    company_id = fields.Many2one('res.company', string='Company', required=True,
+                                 default=lambda self: self.env.user.company_id)
+    job_type = fields.Selection([
+        ('confirm', 'Confirmation'),
+        ('payment', 'Payment'),
+    ], string='Type', required=True, readonly=True, default='payment')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='Status', index=True, readonly=True, copy=False, default='pending')
+    chunk_size = fields.Integer(string='Chunk Size', default=100,
+                                help="Number of payslips paid and committed at once.")
+    payslip_done_count = fields.Integer(string='Processed Payslips', readonly=True, copy=False)
+    payslip_failed_count = fields.Integer(string='Failed Payslips', readonly=True, copy=False)
+    payslip_pending_count = fields.Integer(string='Pending Payslips', readonly=True, copy=False)
+    progress = fields.Float(string='Progress', compute='_compute_progress')
+    failed_payslip_ids = fields.Many2many('hr.payslip', 'hr_payslip_run_job_failed_rel', 'job_id', 'payslip_id',
+                                          string='Failed Payslips', readonly=True, copy=False)
+    date_start = fields.Datetime(string='Started on', readonly=True, copy=False)
+    date_end = fields.Datetime(string='Finished on', readonly=True, copy=False)
+    log = fields.Text(string='Log', readonly=True, copy=False)
+
+    @api.depends('payslip_run_id')
+    def _compute_name(self):
+        for job in self:
+            job.name = '%s #%s' % (job.payslip_run_id.name, job.id)
+
+    @api.depends('payslip_done_count', 'payslip_failed_count', 'payslip_pending_count')
+    def _compute_progress(self):
+        for job in self:
+            total = job.payslip_done_count + job.payslip_failed_count + job.payslip_pending_count
+            job.progress = total and 100.0 * (job.payslip_done_count + job.payslip_failed_count) / total or 0.0
+
+    def _is_testing(self):
+        return getattr(threading.currentThread(), 'testing', False)
+
+    def _commit(self):
+        """ Commit the current chunk, unless running the tests where the cursor must not be committed. """
+        if not self._is_testing():
+            self.env.cr.commit()
+
+    def _filter_pending(self, payslips):
+        if self.job_type == 'confirm':
+            return payslips.filtered(lambda payslip: payslip.state == 'draft')
+        return payslips.filtered(lambda payslip: payslip.state == 'done')._filter_unpaid()
+
+    def _get_pending_payslips(self):
+        self.ensure_one()
+        payslips = self.env['hr.payslip'].search([
+            ('payslip_run_id', '=', self.payslip_run_id.id),
+            ('state', '=', self.job_type == 'confirm' and 'draft' or 'done'),
+            ('id', 'not in', self.failed_payslip_ids.ids),
+        ])
+        return self._filter_pending(payslips)
+
+    def _lock_pending_payslips(self, payslips):
+        """ Lock the payslips of a chunk and return the ones still to pay, skipping the payslips locked by
+        another transaction or paid since the chunk was built. """
+        self.env.cr.execute("SELECT id FROM hr_payslip WHERE id IN %s FOR UPDATE SKIP LOCKED",
+                            (tuple(payslips.ids),))
+        locked = payslips.browse([row[0] for row in self.env.cr.fetchall()])
+        locked.invalidate_cache(['state', 'payment_ids'], locked.ids)
+        return self._filter_pending(locked)
+
+    def _process_payslips(self, payslips):
+        if self.job_type == 'confirm':
+            self.payslip_run_id._confirm_payslips(payslips)
+        else:
+            self._pay_payslips(payslips)
+
+    def _is_single_unit(self):
+        """ Whether the payslips of the job are processed all at once: a grouped confirmation builds one journal
+        entry per batch or per journal and date, which chunks would split into one entry each. """
+        return self.job_type == 'confirm' and self.payslip_run_id.move_grouping != 'payslip'
+
+    def _process_chunk(self, payslips):
+        payslips = self._lock_pending_payslips(payslips)
+        if not payslips:
+            return
+        try:
+            with self.env.cr.savepoint():
+                self._process_payslips(payslips)
+        except Exception as e:
+            self.env.clear()
+            if len(payslips) > 1 and not self._is_single_unit():
+                # isolate the failing payslips, and pay the other ones
+                for payslip in payslips:
+                    self._process_chunk(payslip)
+                return
+            _logger.exception("Payslips %s failed in job %s", payslips.ids, self.id)
+            self.write({
+                'failed_payslip_ids': [(4, payslip_id) for payslip_id in payslips.ids],
+                'payslip_failed_count': self.payslip_failed_count + len(payslips),
+                'log': '%s%s: %s\n' % (self.log or '', ', '.join(payslips.mapped('name')), e),
+            })
+            return
+        self.write({'payslip_done_count': self.payslip_done_count + len(payslips)})
+
+    @api.multi
+    @profiled('payslip_run_job', lambda jobs: jobs.mapped('payslip_run_id'))
+    def _run(self):
+        profiler = get_profiler(self.env)
+        for job in self:
+            payslips = job._get_pending_payslips()
+            job.write({
+                'state': 'running',
+                'date_start': fields.Datetime.now(),
+                'payslip_pending_count': len(payslips),
+            })
+            job._commit()
+            chunk_size = not job._is_single_unit() and job.chunk_size or len(payslips) or 1
+            for payslip_ids in split_every(chunk_size, payslips.ids):
+                processed_count = job.payslip_done_count + job.payslip_failed_count
+                with profiler.phase('chunk', len(payslip_ids)):
+                    job._process_chunk(self.env['hr.payslip'].browse(payslip_ids))
+                processed_count = job.payslip_done_count + job.payslip_failed_count - processed_count
+                job.payslip_pending_count = max(job.payslip_pending_count - processed_count, 0)
+                job._commit()
+            # the payslips skipped by a chunk are only known once the batch is scanned again
+            job.payslip_pending_count = len(job._get_pending_payslips())
+            if job.payslip_pending_count:
+                # payslips locked by another transaction were skipped, leave them to the next run of the queue
+                job.write({
+                    'state': 'pending',
+                    'log': '%s%d payslips were locked and are left pending.\n' % (
+                        job.log or '', job.payslip_pending_count),
+                })
+                job._commit()
+                continue
+            job._finish()
+            job.write({'state': 'done', 'date_end': fields.Datetime.now()})
+            job._commit()
+
+    def _finish(self):
+        """ Move the batch to its next state, once all its payslips are processed. """
+        if self.job_type == 'confirm':
+            if not self.failed_payslip_ids:
+                self.payslip_run_id.write({'state': 'done'})
+        else:
+            self.payslip_run_id._check_paid_state()
+
+    def _get_stale_date(self):
+        """ Return the date before which a running job without activity is considered as left by a killed worker """
+        timeout = int(self.env['ir.config_parameter'].sudo().get_param('payslip_payment.job_timeout', 60))
+        now = fields.Datetime.from_string(fields.Datetime.now())
+        return fields.Datetime.to_string(now - timedelta(minutes=timeout))
+
+    @api.model
+    def _claim_job(self, exclude_ids=()):
+        """ Lock and return the oldest pending or stale running job whose batch has no other live running job,
+        skipping the given jobs and the jobs and batches locked by the other workers. """
+        self.env.cr.execute("""
+            SELECT job.id
+              FROM hr_payslip_run_job job
+              JOIN hr_payslip_run run ON run.id = job.payslip_run_id
+             WHERE (job.state = 'pending' OR (job.state = 'running' AND job.write_date < %(stale_date)s))
+               AND job.id NOT IN %(exclude_ids)s
+               AND NOT EXISTS (SELECT 1 FROM hr_payslip_run_job other
+                                WHERE other.payslip_run_id = job.payslip_run_id AND other.id != job.id
+                                  AND other.state = 'running' AND other.write_date >= %(stale_date)s)
+          ORDER BY job.id
+             LIMIT 1
+               FOR UPDATE OF job, run SKIP LOCKED
+        """, {'stale_date': self._get_stale_date(), 'exclude_ids': tuple(exclude_ids) or (0,)})
+        row = self.env.cr.fetchone()
+        return self.browse(row[0] if row else [])
+
+    @api.model
+    def _process_jobs(self):
+        """ Drain the queue with the current cursor. A job left pending is not claimed again by the same drain. """
+        claimed_ids = set()
+        while True:
+            job = self._claim_job(claimed_ids)
+            if not job:
+                break
+            claimed_ids.add(job.id)
+            try:
+                job._run()
+            except Exception as e:
+                if self._is_testing():
+                    raise
+                self.env.cr.rollback()
+                self.env.clear()
+                _logger.exception("Payslip batch job %s failed", job.id)
+                job.write({'state': 'failed', 'log': '%s%s\n' % (job.log or '', e)})
+                job._commit()
+
+    def _process_jobs_thread(self):
+        with api.Environment.manage():
+            with self.pool.cursor() as cr:
+                self.with_env(self.env(cr=cr))._process_jobs()
+
+    @api.model
+    def _cron_process_jobs(self):
+        """ Worker of the job queue. Up to `payslip_payment.job_concurrency` jobs of different batches are run in
+        parallel, each one in its own thread and cursor. """
+        concurrency = int(self.env['ir.config_parameter'].sudo().get_param('payslip_payment.job_concurrency', 1))
+        if concurrency <= 1 or self._is_testing():
+            self._process_jobs()
+            return
+        threads = [threading.Thread(target=self._process_jobs_thread) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    @api.multi
+    def action_resume(self):
+        jobs = self.filtered(lambda job: job.state != 'done')
+        # give the payslips that failed another chance
+        jobs.write({'failed_payslip_ids': [(5,)], 'payslip_failed_count': 0})
+        jobs._run()
+        return True
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from odoo import fields, models
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    payslip_payment_summary = fields.Boolean(
+        'Summarize Payslip Payments',
+        help="Log a single message per payment run on the payslip batch instead of one message per payslip.")
+    payslip_refund_reversal = fields.Boolean(
+        'Reverse Refunded Payslip Entries',
+        help="Reverse the journal entries of the refunded payslips instead of deleting them.")
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+""" Opt-in profiling of the payslip payment flows.
+
+Profiling is enabled with the ``payslip_profile`` context key or the ``payslip_payment.profiling`` system parameter.
+The entry points decorated with :func:`profiled` then carry a :class:`PaymentProfiler` in their context, and every
+phase they go through, including the phases of the methods they call, records its wall time, its number of SQL
+queries and the number of records it handled. Phases may nest, their figures are inclusive. The summary is logged
+and stored on the payslip batches involved.
+"""
+import functools
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from odoo import fields
+
+_logger = logging.getLogger(__name__)
+
+CONTEXT_KEY = 'payslip_profiler'
+
+
+class PaymentProfiler(object):
+
+    def __init__(self, cr, name):
+        self.cr = cr
+        self.name = name
+        self.phases = OrderedDict()
+        self.start = time.time()
+        self.start_queries = cr.sql_log_count
+
+    @contextmanager
+    def phase(self, name, records=0):
+        queries = self.cr.sql_log_count
+        start = time.time()
+        try:
+            yield
+        finally:
+            stats = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'queries': 0, 'records': 0})
+            stats['calls'] += 1
+            stats['seconds'] += time.time() - start
+            stats['queries'] += self.cr.sql_log_count - queries
+            stats['records'] += records
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'seconds': round(time.time() - self.start, 3),
+            'queries': self.cr.sql_log_count - self.start_queries,
+            'phases': OrderedDict((name, dict(stats, seconds=round(stats['seconds'], 3)))
+                                  for name, stats in self.phases.items()),
+        }
+
+
+class _NullProfiler(object):
+
+    @contextmanager
+    def phase(self, name, records=0):
+        yield
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+def is_enabled(env):
+    if env.context.get('payslip_profile'):
+        return True
+    value = env['ir.config_parameter'].sudo().get_param('payslip_payment.profiling')
+    return bool(value) and value.lower() not in ('0', 'false')
+
+
+def get_profiler(env):
+    """ Return the profiler of the current flow, or a profiler doing nothing when it is not profiled. """
+    return env.context.get(CONTEXT_KEY) or NULL_PROFILER
+
+
+def profiled(name, get_runs=None):
+    """ Profile the decorated method when profiling is enabled and the method is not already called by a profiled
+    flow. ``get_runs`` returns the payslip batches of the records, which the summary is stored on. """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if CONTEXT_KEY in self.env.context or not is_enabled(self.env):
+                return method(self, *args, **kwargs)
+            profiler = PaymentProfiler(self.env.cr, name)
+            records = self.with_context(**{CONTEXT_KEY: profiler})
+            runs = get_runs(records) if get_runs else None
+            result = method(records, *args, **kwargs)
+            summary = profiler.summary()
+            summary['records'] = len(self)
+            _logger.info("Payslip payment profile: %s", json.dumps(summary))
+            if runs:
+                runs.sudo().write({
+                    'payment_profile': json.dumps(summary, indent=2),
+                    'payment_profile_date': fields.Datetime.now(),
+                })
+            return result
+        return wrapper
+    return decorator
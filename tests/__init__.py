@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+
+from . import test_payslip_payment
+from . import test_payslip_payment_benchmark
\ No newline at end of file
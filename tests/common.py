@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from odoo import fields
+from odoo.tests import common
+
+
+class PayslipPaymentCase(common.TransactionCase):
+    """ Accounting setup shared by the payslip payment tests: a payable, an expense and a bank account, a payroll
+    and a bank journal, and the salary rules of the base structure posting to them. """
+
+    def setUp(self):
+        super(PayslipPaymentCase, self).setUp()
+        self.company = self.env.user.company_id
+        Account = self.env['account.account']
+        self.payable_account = Account.create({
+            'name': 'Salaries Payable', 'code': 'TPP01', 'reconcile': True,
+            'user_type_id': self.env.ref('account.data_account_type_payable').id,
+        })
+        self.expense_account = Account.create({
+            'name': 'Salaries', 'code': 'TPP02',
+            'user_type_id': self.env.ref('account.data_account_type_expenses').id,
+        })
+        self.bank_account = Account.create({
+            'name': 'Salary Bank', 'code': 'TPP03',
+            'user_type_id': self.env.ref('account.data_account_type_liquidity').id,
+        })
+        Journal = self.env['account.journal']
+        self.payroll_journal = Journal.create({
+            'name': 'Test Payroll', 'code': 'TPPR', 'type': 'general',
+            'default_debit_account_id': self.expense_account.id,
+            'default_credit_account_id': self.expense_account.id,
+        })
+        self.bank_journal = Journal.create({
+            'name': 'Test Bank', 'code': 'TPBK', 'type': 'bank',
+            'default_debit_account_id': self.bank_account.id,
+            'default_credit_account_id': self.bank_account.id,
+        })
+        self.payment_method = self.env.ref('account.account_payment_method_manual_out')
+        self.structure = self.env.ref('hr_payroll.structure_base')
+        self.env.ref('hr_payroll.hr_rule_basic').account_debit = self.expense_account
+        self.env.ref('hr_payroll.hr_rule_net').account_credit = self.payable_account
+        self.date_from = fields.Date.to_string(fields.Date.from_string(fields.Date.today()).replace(day=1))
+        self.date_to = fields.Date.today()
+
+    def _create_contracts(self, size, name='Test'):
+        """ Create the given number of employees, with a private address and a running contract each """
+        Employee = self.env['hr.employee']
+        Contract = self.env['hr.contract']
+        contracts = Contract
+        for index in range(size):
+            partner = self.env['res.partner'].create({
+                'name': '%s Employee %s' % (name, index),
+                'property_account_payable_id': self.payable_account.id,
+            })
+            employee = Employee.create({'name': partner.name, 'address_home_id': partner.id})
+            contracts |= Contract.create({
+                'name': '%s Contract %s' % (name, index),
+                'employee_id': employee.id,
+                'wage': 1000.0 + index,
+                'struct_id': self.structure.id,
+                'journal_id': self.payroll_journal.id,
+                'date_start': self.date_from,
+                'state': 'open',
+            })
+        return contracts
+
+    def _create_run(self, contracts, name='Test Batch'):
+        """ Create a batch holding a draft payslip per contract """
+        run = self.env['hr.payslip.run'].create({
+            'name': name,
+            'date_start': self.date_from,
+            'date_end': self.date_to,
+            'journal_id': self.payroll_journal.id,
+        })
+        for contract in contracts:
+            self.env['hr.payslip'].create({
+                'name': '%s %s' % (name, contract.employee_id.name),
+                'employee_id': contract.employee_id.id,
+                'contract_id': contract.id,
+                'struct_id': self.structure.id,
+                'date_from': self.date_from,
+                'date_to': self.date_to,
+                'journal_id': self.payroll_journal.id,
+                'payslip_run_id': run.id,
+            })
+        return run
+
+    def _prepare_payment_vals(self, slip, amount=None):
+        return {
+            'partner_type': 'supplier',
+            'payment_type': 'outbound',
+            'partner_id': slip.employee_id.address_home_id.id,
+            'journal_id': self.bank_journal.id,
+            'payment_method_id': self.payment_method.id,
+            'amount': slip.total_amount if amount is None else amount,
+            'currency_id': self.company.currency_id.id,
+            'payment_date': fields.Date.today(),
+            'payslip_id': slip.id,
+        }
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import base64
+from unittest.mock import patch
+
+from lxml import etree
+
+from odoo import fields
+from odoo.exceptions import ValidationError
+from odoo.tests import common
+
+from .common import PayslipPaymentCase
+
+
+class WorkerKilled(Exception):
+    pass
+
+
+@common.at_install(False)
+@common.post_install(True)
+class TestPayslipPayment(PayslipPaymentCase):
+
+    def test_post_payments_sharing_payable_account(self):
+        """ Payments of several payslips posted together share their destination account """
+        run = self._create_run(self._create_contracts(3))
+        run.batch_wise_payslip_confirm()
+        payments = self.env['account.payment']
+        for slip in run.slip_ids:
+            payments |= payments.create(self._prepare_payment_vals(slip))
+        payments.post()
+
+        self.assertEqual(set(payments.mapped('state')), {'posted'})
+        self.assertEqual(payments.mapped('destination_account_id'), self.payable_account)
+        self.assertEqual(set(run.slip_ids.mapped('state')), {'paid'})
+        self.assertEqual(run.state, 'paid')
+
+    def _get_residual_amounts_orm(self, slips):
+        """ Return the residual amounts of the payslips from the ORM fallback, which a pending residual of any
+        journal item switches to. """
+        field = self.env['account.move.line']._fields['amount_residual']
+        line = self.env['account.move.line'].search([], limit=1)
+        self.env.add_todo(field, line)
+        try:
+            return slips._get_residual_amounts()
+        finally:
+            self.env.remove_todo(field, line)
+
+    def test_residual_amounts_sql_matches_orm(self):
+        """ The grouped query of the residual amounts gives the amounts of the ORM fallback """
+        currency = self.env.ref('base.EUR')
+        if currency == self.company.currency_id:
+            currency = self.env.ref('base.USD')
+        currency.active = True
+        self.env['res.currency.rate'].create({
+            'name': fields.Date.today(), 'rate': 2.0, 'currency_id': currency.id, 'company_id': self.company.id,
+        })
+        run = self._create_run(self._create_contracts(5), name='Residual Batch')
+        credit_note, foreign_slip, paid_slip, unpaid_slip, empty_slip = run.slip_ids
+        credit_note.credit_note = True
+        foreign_slip.currency_id = currency
+        run.batch_wise_payslip_confirm()
+
+        # a partial payment in foreign currency, and a full payment in company currency
+        payments = self.env['account.payment'].create(dict(
+            self._prepare_payment_vals(foreign_slip, amount=100.0), currency_id=currency.id))
+        payments |= payments.create(self._prepare_payment_vals(paid_slip))
+        payments.post()
+        # a payslip whose journal entry has no line is left out by both
+        empty_slip.move_id = self.env['account.move'].create({
+            'journal_id': self.payroll_journal.id, 'date': fields.Date.today(),
+        })
+        self.env['account.move.line'].recompute()
+        self.assertFalse(self.env.field_todo(self.env['account.move.line']._fields['amount_residual']))
+
+        slips = run.slip_ids
+        sql_amounts = slips._get_residual_amounts()
+        orm_amounts = self._get_residual_amounts_orm(slips)
+        self.assertEqual(set(sql_amounts), set((credit_note | foreign_slip | paid_slip | unpaid_slip).ids))
+        self.assertEqual(set(sql_amounts), set(orm_amounts))
+        for slip_id, (residual, residual_company_signed) in sql_amounts.items():
+            self.assertAlmostEqual(residual, orm_amounts[slip_id][0], places=2)
+            self.assertAlmostEqual(residual_company_signed, orm_amounts[slip_id][1], places=2)
+        self.assertAlmostEqual(sql_amounts[paid_slip.id][1], 0.0, places=2)
+        # the payable item of a credit note is a debit
+        self.assertGreater(sql_amounts[credit_note.id][1], 0.0)
+        self.assertLess(sql_amounts[unpaid_slip.id][1], 0.0)
+
+    def test_total_amount_sql_matches_loop(self):
+        """ The grouped sum of the payslip lines gives the totals of the loop over the lines """
+        run = self._create_run(self._create_contracts(3), name='Total Batch')
+        slips = run.slip_ids
+        slips[0].credit_note = True
+        slips.compute_sheet()
+        # lines rounded to zero are left out by both
+        rule = self.env.ref('hr_payroll.hr_rule_basic')
+        for slip in slips:
+            for amount in (0.004, -0.004, 10.004):
+                self.env['hr.payslip.line'].create({
+                    'slip_id': slip.id,
+                    'salary_rule_id': rule.id,
+                    'category_id': rule.category_id.id,
+                    'contract_id': slip.contract_id.id,
+                    'employee_id': slip.employee_id.id,
+                    'name': 'Rounding',
+                    'code': 'RND',
+                    'amount': amount,
+                })
+        self.env['hr.payslip.line'].recompute()
+        self.assertFalse(self.env.field_todo(self.env['hr.payslip.line']._fields['total']))
+
+        with self.env.do_in_draft():
+            slips._compute_total_amount()
+            sql_totals = {slip.id: slip.total_amount for slip in slips}
+            for slip in slips:
+                slip._compute_total_amount()
+            loop_totals = {slip.id: slip.total_amount for slip in slips}
+        self.assertEqual(set(sql_totals), set(loop_totals))
+        for slip_id, total in sql_totals.items():
+            self.assertAlmostEqual(total, loop_totals[slip_id], places=2)
+        self.assertLess(sql_totals[slips[0].id], 0.0)
+        self.assertGreater(sql_totals[slips[1].id], 0.0)
+
+    def test_grouped_payment_summary(self):
+        """ The payment of several payslips of an employee is counted once in the summary of the batch """
+        self.company.payslip_payment_summary = True
+        run = self._create_run(self._create_contracts(1), name='Summary Batch')
+        run.slip_ids.copy({'name': 'Summary Batch Bonus', 'payslip_run_id': run.id})
+        run.batch_wise_payslip_confirm()
+        slips = run.slip_ids
+        self.assertEqual(len(slips), 2)
+        total = sum(slips.mapped('total_amount'))
+
+        self.env['hr.payslip.register.payment.wizard'].with_context(active_ids=slips.ids).create({
+            'journal_id': self.bank_journal.id,
+            'payment_method_id': self.payment_method.id,
+            'amount': total,
+            'group_by_employee': True,
+        }).expense_post_payment()
+
+        payment = slips.mapped('grouped_payment_ids')
+        self.assertEqual(len(payment), 1)
+        self.assertAlmostEqual(payment.amount, total, places=2)
+        self.assertAlmostEqual(sum(amount for payslip, amount in payment._get_payslip_shares(
+            {slip.id: slip.total_amount for slip in slips})), total, places=2)
+        summaries = run.message_ids.filtered(lambda message: 'payslips have been paid' in (message.body or ''))
+        self.assertEqual(len(summaries), 1)
+        self.assertIn('%.2f' % total, summaries.body)
+        self.assertNotIn('%.2f' % (2 * total), summaries.body)
+
+    def test_resume_interrupted_payment_job(self):
+        """ A payment job interrupted after a chunk is taken over by the queue without paying anyone twice """
+        run = self._create_run(self._create_contracts(5), name='Job Batch')
+        run.batch_wise_payslip_confirm()
+        Job = self.env['hr.payslip.run.job']
+        job = Job.create({
+            'payslip_run_id': run.id,
+            'journal_id': self.bank_journal.id,
+            'payment_method_id': self.payment_method.id,
+            'chunk_size': 2,
+            'job_type': 'payment',
+        })
+
+        # the worker is killed after its first chunk
+        process_chunk = type(job)._process_chunk
+        chunks = []
+
+        def interrupted_process_chunk(job, payslips):
+            if chunks:
+                raise WorkerKilled()
+            chunks.append(payslips)
+            return process_chunk(job, payslips)
+
+        with patch.object(type(job), '_process_chunk', interrupted_process_chunk):
+            with self.assertRaises(WorkerKilled):
+                job._run()
+        self.assertEqual(job.state, 'running')
+        self.assertEqual(job.payslip_done_count, 2)
+        self.assertEqual(job.payslip_pending_count, 3)
+
+        # the job is stale once its timeout is over, then resumed by the queue
+        self.assertFalse(Job._claim_job())
+        self.env.cr.execute("UPDATE hr_payslip_run_job SET write_date = write_date - interval '2 hours' WHERE id = %s",
+                            (job.id,))
+        job.invalidate_cache()
+        Job._process_jobs()
+
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.payslip_pending_count, 0)
+        for slip in run.slip_ids:
+            self.assertEqual(self.env['account.payment'].search_count([
+                ('payslip_id', '=', slip.id), ('state', 'in', ('posted', 'sent', 'reconciled')),
+            ]), 1)
+        self.assertEqual(run.state, 'paid')
+
+    def test_grouped_journal_entry(self):
+        """ A batch confirmed with a journal entry per batch gives the residuals of an entry per payslip """
+        contracts = self._create_contracts(3, name='Grouped')
+        run_per_payslip = self._create_run(contracts, name='Per Payslip Batch')
+        run_grouped = self._create_run(contracts, name='Grouped Batch')
+        run_grouped.move_grouping = 'run'
+        run_per_payslip.batch_wise_payslip_confirm()
+        run_grouped.batch_wise_payslip_confirm()
+
+        move = run_grouped.slip_ids.mapped('move_id')
+        self.assertEqual(len(move), 1)
+        self.assertEqual(move.state, 'posted')
+        self.assertAlmostEqual(sum(move.line_ids.mapped('debit')), sum(move.line_ids.mapped('credit')), places=2)
+        for slip in run_grouped.slip_ids:
+            payable_lines = move.line_ids.filtered(
+                lambda line: line.account_id == self.payable_account and line.payslip_id == slip)
+            self.assertEqual(len(payable_lines), 1)
+            self.assertEqual(payable_lines.partner_id, slip.employee_id.address_home_id)
+        self.assertFalse(move.line_ids.filtered(
+            lambda line: line.account_id == self.payable_account and not line.payslip_id))
+
+        slips_per_payslip = {slip.employee_id: slip for slip in run_per_payslip.slip_ids}
+        for slip in run_grouped.slip_ids:
+            other_slip = slips_per_payslip[slip.employee_id]
+            self.assertNotEqual(other_slip.move_id, move)
+            self.assertAlmostEqual(slip.residual_company_signed, other_slip.residual_company_signed, places=2)
+            self.assertAlmostEqual(slip.residual, other_slip.residual, places=2)
+            self.assertFalse(slip.reconciled)
+
+    def test_refund_deletes_journal_entries(self):
+        """ Refunding payslips deletes their journal entries and sets them back to draft """
+        run = self._create_run(self._create_contracts(2, name='Refund'), name='Refund Batch')
+        run.batch_wise_payslip_confirm()
+        slips = run.slip_ids
+        moves = slips.mapped('move_id')
+        self.assertEqual(len(moves), 2)
+
+        slips.refund_sheet()
+        self.assertEqual(set(slips.mapped('state')), {'draft'})
+        self.assertFalse(moves.exists())
+        self.assertFalse(self.env['hr.payslip.liability'].search([('payslip_id', 'in', slips.ids)]))
+
+    def test_refund_reverses_journal_entries(self):
+        """ Refunding payslips of a company keeping its journal entries reverses them """
+        self.company.payslip_refund_reversal = True
+        run = self._create_run(self._create_contracts(2, name='Reversal'), name='Reversal Batch')
+        run.batch_wise_payslip_confirm()
+        slips = run.slip_ids
+        moves = slips.mapped('move_id')
+
+        slips.refund_sheet()
+        self.assertEqual(set(slips.mapped('state')), {'draft'})
+        self.assertEqual(moves.exists(), moves)
+        self.assertEqual(set(moves.mapped('state')), {'posted'})
+        payable_lines = moves.mapped('line_ids').filtered(lambda line: line.account_id == self.payable_account)
+        self.assertTrue(payable_lines)
+        self.assertTrue(all(payable_lines.mapped('reconciled')))
+
+    def test_refund_refused(self):
+        """ Payslips sharing a journal entry with others, or paid by a salary transfer, cannot be refunded """
+        run = self._create_run(self._create_contracts(2, name='Shared'), name='Shared Batch')
+        run.move_grouping = 'run'
+        run.batch_wise_payslip_confirm()
+        with self.assertRaises(ValidationError):
+            run.slip_ids[0].refund_sheet()
+
+        run = self._create_run(self._create_contracts(2, name='Transfer'), name='Transfer Batch')
+        run.batch_wise_payslip_confirm()
+        self.env['hr.payslip.batchwise.register.payment.wizard'].create({
+            'batch_id': run.id,
+            'journal_id': self.bank_journal.id,
+            'payment_method_id': self.payment_method.id,
+            'consolidate': True,
+        }).expense_post_payment()
+        with self.assertRaises(ValidationError):
+            run.slip_ids[0].refund_sheet()
+
+    def test_export_pain001(self):
+        """ The pain.001 file of a batch paid by a single transfer holds the transfers to the employees only """
+        self.bank_journal.bank_account_id = self.env['res.partner.bank'].create({
+            'acc_number': 'BE71 0961 2345 6769', 'partner_id': self.company.partner_id.id,
+        })
+        run = self._create_run(self._create_contracts(3, name='Export'), name='Export Batch')
+        credit_note, slip_with_bic, slip_without_bic = run.slip_ids
+        credit_note.credit_note = True
+        bank = self.env['res.bank'].create({'name': 'Employee Bank', 'bic': 'EMPLBEBB'})
+        for slip, iban, bank_id in ((slip_with_bic, 'DE89 3704 0044 0532 0130 00', bank.id),
+                                    (slip_without_bic, 'FR14 2004 1010 0505 0001 3M02 606', False)):
+            slip.employee_id.bank_account_id = self.env['res.partner.bank'].create({
+                'acc_number': iban, 'partner_id': slip.employee_id.address_home_id.id, 'bank_id': bank_id,
+            })
+        run.batch_wise_payslip_confirm()
+        self.env['hr.payslip.batchwise.register.payment.wizard'].create({
+            'batch_id': run.id,
+            'journal_id': self.bank_journal.id,
+            'payment_method_id': self.payment_method.id,
+            'consolidate': True,
+        }).expense_post_payment()
+
+        action = run.action_export_bank_file()
+        attachment = self.env['ir.attachment'].browse(int(action['url'].split('/')[-1].split('?')[0]))
+        document = etree.fromstring(base64.b64decode(attachment.datas))
+        namespaces = {'p': 'urn:iso:std:iso:20022:tech:xsd:pain.001.001.03'}
+
+        transfers = document.xpath('//p:CdtTrfTxInf', namespaces=namespaces)
+        self.assertEqual(len(transfers), 2)
+        self.assertEqual(document.xpath('string(//p:GrpHdr/p:NbOfTxs)', namespaces=namespaces), '2')
+        amounts = [float(amount) for amount in document.xpath('//p:InstdAmt/text()', namespaces=namespaces)]
+        self.assertTrue(all(amount > 0.0 for amount in amounts))
+        self.assertAlmostEqual(float(document.xpath('string(//p:GrpHdr/p:CtrlSum)', namespaces=namespaces)),
+                               sum(amounts), places=2)
+        self.assertFalse(document.xpath('//p:BIC[not(normalize-space())]', namespaces=namespaces))
+        self.assertEqual(document.xpath('string(//p:DbtrAgt//p:Othr/p:Id)', namespaces=namespaces), 'NOTPROVIDED')
+        agents = {transfer.xpath('string(p:CdtrAcct//p:IBAN)', namespaces=namespaces):
+                  transfer.xpath('string(p:CdtrAgt//p:BIC)', namespaces=namespaces) for transfer in transfers}
+        self.assertEqual(agents, {'DE89370400440532013000': 'EMPLBEBB', 'FR1420041010050500013M02606': ''})
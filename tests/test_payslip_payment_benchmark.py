@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+""" Benchmark of the payslip payment flows.
+
+The benchmark is skipped unless the PAYSLIP_PAYMENT_BENCHMARK environment variable is set, e.g.::
+
+    PAYSLIP_PAYMENT_BENCHMARK=1 PAYSLIP_PAYMENT_BENCHMARK_SIZES=100,1000,10000 \\
+    PAYSLIP_PAYMENT_BENCHMARK_OUTPUT=/tmp/payslip_benchmark.json \\
+    odoo-bin -d bench -i payslip_payment --test-enable --stop-after-init
+
+For every batch size, synthetic employees, contracts and payslip batches are created, then the wall time and the
+number of SQL queries of every flow, and of the profiled phases it goes through, are measured. The results are
+written as JSON along with the thresholds they are checked against:
+
+* ``queries_per_slip``: the maximum number of queries per payslip of a flow, at every size;
+* ``queries_slope``: the maximum number of queries a flow may add per additional payslip, between the smallest and
+  the largest size;
+* ``phases_slope``: the same maximum for the phases of a flow, the set-based phases adding next to no query whatever
+  the batch size.
+
+The slopes are only checked when at least two sizes are benchmarked. The recomputations are measured through the ORM
+recompute, which computes the whole recordset at once but still stores every payslip with its own update, hence a
+slope of about one query per payslip. The thresholds can be overridden with a JSON file given in
+PAYSLIP_PAYMENT_BENCHMARK_THRESHOLDS.
+"""
+import json
+import logging
+import os
+import time
+import unittest
+from contextlib import contextmanager
+
+from odoo.tests import common
+
+from ..profiler import CONTEXT_KEY, PaymentProfiler
+from .common import PayslipPaymentCase
+
+_logger = logging.getLogger(__name__)
+
+THRESHOLDS = {
+    'batch_wise_payslip_confirm': {'queries_per_slip': 150},
+    'compute_total_amount': {'queries_per_slip': 3, 'queries_slope': 1.5, 'phases_slope': {'total amounts': 0.05}},
+    'compute_residual': {'queries_per_slip': 3, 'queries_slope': 1.5, 'phases_slope': {'residual amounts': 0.05}},
+    'batchwise_register_payment': {'queries_per_slip': 120,
+                                   'phases_slope': {'select payslips': 0.05, 'prepare payments': 0.05}},
+    'register_payment': {'queries_per_slip': 150},
+    'account_payment_post': {'queries_per_slip': 100, 'phases_slope': {'destination accounts': 0.05}},
+    'account_move_line_reconcile': {'queries_per_slip': 60},
+}
+
+
+def _get_sizes():
+    return [int(size) for size in os.environ.get('PAYSLIP_PAYMENT_BENCHMARK_SIZES', '100,500').split(',') if size]
+
+
+def _get_thresholds():
+    thresholds = dict(THRESHOLDS)
+    path = os.environ.get('PAYSLIP_PAYMENT_BENCHMARK_THRESHOLDS')
+    if path:
+        with open(path) as thresholds_file:
+            thresholds.update(json.load(thresholds_file))
+    return thresholds
+
+
+@common.at_install(False)
+@common.post_install(True)
+@unittest.skipUnless(os.environ.get('PAYSLIP_PAYMENT_BENCHMARK'), "payslip payment benchmark not requested")
+class TestPayslipPaymentBenchmark(PayslipPaymentCase):
+
+    def setUp(self):
+        super(TestPayslipPaymentBenchmark, self).setUp()
+        self.results = []
+
+    @contextmanager
+    def _measure(self, operation, size):
+        """ Measure the operation, which runs with the yielded context to record its phases """
+        self.env.invalidate_all()
+        profiler = PaymentProfiler(self.cr, operation)
+        queries = self.cr.sql_log_count
+        start = time.time()
+        yield {CONTEXT_KEY: profiler}
+        self.env['hr.payslip'].recompute()
+        result = {
+            'operation': operation,
+            'size': size,
+            'seconds': round(time.time() - start, 3),
+            'queries': self.cr.sql_log_count - queries,
+            'phases': {name: stats['queries'] for name, stats in profiler.phases.items()},
+        }
+        result['queries_per_slip'] = round(float(result['queries']) / size, 2)
+        result['threshold'] = self.thresholds.get(operation, {})
+        _logger.info("Benchmark %(operation)s on %(size)s payslips: %(seconds)ss, %(queries)s queries", result)
+        self.results.append(result)
+
+    def _benchmark_size(self, size):
+        contracts = self._create_contracts(size, 'Benchmark %s' % size)
+        runs = [self._create_run(contracts, 'Benchmark %s %s' % (size, name))
+                for name in ('wizard', 'single', 'post', 'reconcile')]
+        for run in runs[1:]:
+            run.batch_wise_payslip_confirm()
+
+        run = runs[0]
+        with self._measure('batch_wise_payslip_confirm', size) as context:
+            run.with_context(context).batch_wise_payslip_confirm()
+
+        slips = run.slip_ids
+        Payslip = self.env['hr.payslip']
+        with self._measure('compute_total_amount', size) as context:
+            self.env.add_todo(Payslip._fields['total_amount'], slips.with_context(context))
+            Payslip.recompute()
+        with self._measure('compute_residual', size) as context:
+            self.env.add_todo(Payslip._fields['residual'], slips.with_context(context))
+            Payslip.recompute()
+
+        wizard = self.env['hr.payslip.batchwise.register.payment.wizard'].create({
+            'batch_id': run.id,
+            'journal_id': self.bank_journal.id,
+            'payment_method_id': self.payment_method.id,
+        })
+        with self._measure('batchwise_register_payment', size) as context:
+            wizard.with_context(context).expense_post_payment()
+
+        with self._measure('register_payment', size) as context:
+            for slip in runs[1].slip_ids:
+                Wizard = self.env['hr.payslip.register.payment.wizard'].with_context(context, active_ids=slip.ids)
+                Wizard.create({
+                    'journal_id': self.bank_journal.id,
+                    'payment_method_id': self.payment_method.id,
+                    'amount': slip.residual_company_signed,
+                }).expense_post_payment()
+
+        payments = self.env['account.payment']
+        for slip in runs[2].slip_ids:
+            payments |= payments.create(self._prepare_payment_vals(slip))
+        with self._measure('account_payment_post', size) as context:
+            payments.with_context(context).post()
+
+        slips = runs[3].slip_ids
+        for slip in slips:
+            # post without the payslip hooks, leaving the payable lines to reconcile
+            self.env['account.payment'].create(self._prepare_payment_vals(slip)).with_context(
+                destination_account_id=self.payable_account).post()
+        lines_by_partner = {}
+        for line in slips.mapped('move_id.line_ids') | slips.mapped('payment_ids.move_line_ids'):
+            if line.account_id == self.payable_account:
+                lines_by_partner.setdefault(line.partner_id, self.env['account.move.line'])
+                lines_by_partner[line.partner_id] |= line
+        with self._measure('account_move_line_reconcile', size) as context:
+            for lines in lines_by_partner.values():
+                lines.with_context(context).reconcile()
+
+    def _check_thresholds(self):
+        failures = []
+        results_by_operation = {}
+        for result in self.results:
+            results_by_operation.setdefault(result['operation'], []).append(result)
+            threshold = result['threshold']
+            for phase in threshold.get('phases_slope', {}):
+                if phase not in result['phases']:
+                    # e.g. the set-based path left for the fallback
+                    failures.append('%s on %s payslips: phase %s not run' % (result['operation'], result['size'],
+                                                                             phase))
+            if 'queries_per_slip' in threshold and result['queries_per_slip'] > threshold['queries_per_slip']:
+                failures.append('%(operation)s on %(size)s payslips: %(queries_per_slip)s queries per payslip'
+                                % result)
+
+        # the queries added between the smallest and the largest batch, per additional payslip
+        for operation, results in results_by_operation.items():
+            small = min(results, key=lambda result: result['size'])
+            large = max(results, key=lambda result: result['size'])
+            if large['size'] == small['size']:
+                continue
+            threshold = large['threshold']
+            slopes = [(operation, large['queries'] - small['queries'], threshold.get('queries_slope'))]
+            slopes += [('%s/%s' % (operation, phase), large['phases'].get(phase, 0) - small['phases'].get(phase, 0),
+                        max_slope) for phase, max_slope in threshold.get('phases_slope', {}).items()]
+            for name, queries, max_slope in slopes:
+                slope = float(queries) / (large['size'] - small['size'])
+                if max_slope is not None and slope > max_slope:
+                    failures.append('%s from %s to %s payslips: %.2f queries per additional payslip' % (
+                        name, small['size'], large['size'], slope))
+        return failures
+
+    def test_benchmark(self):
+        self.thresholds = _get_thresholds()
+        sizes = _get_sizes()
+        for size in sizes:
+            self._benchmark_size(size)
+
+        output = os.environ.get('PAYSLIP_PAYMENT_BENCHMARK_OUTPUT')
+        if output:
+            with open(output, 'w') as output_file:
+                json.dump({'sizes': sizes, 'thresholds': self.thresholds, 'results': self.results},
+                          output_file, indent=2, sort_keys=True)
+
+        failures = self._check_thresholds()
+        self.assertFalse(failures, "Benchmark thresholds exceeded:\n%s" % '\n'.join(failures))
@@ -2,4 +2,5 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
 from . import hr_payroll_register_payment
-from . import hr_payroll_batchwise_register_payment
\ No newline at end of file
+from . import hr_payroll_batchwise_register_payment
+from . import hr_payslip_bank_statement_import
\ No newline at end of file
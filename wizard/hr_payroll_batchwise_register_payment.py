@@ -2,9 +2,9 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 import logging
 
-from odoo import api, fields, models, _
-from odoo.exceptions import ValidationError
-from werkzeug import url_encode
+from odoo import api, fields, models
+
+from ..profiler import get_profiler, profiled
 
 _logger = logging.getLogger(__name__)
 
@@ -12,6 +12,7 @@ _logger = logging.getLogger(__name__)
 class HrPayslipBatchwiseRegisterPaymentWizard(models.TransientModel):
 
     _name = "hr.payslip.batchwise.register.payment.wizard"
+    _inherit = ['hr.payslip.payment.mixin']
     _description = "Batch Wise Register Payment wizard"
 
     batch_id = fields.Many2one('hr.payslip.run','Batch Name')
@@ -22,6 +23,10 @@ class HrPayslipBatchwiseRegisterPaymentWizard(models.TransientModel):
     currency_id = fields.Many2one('res.currency', string='Currency', required=True, default=lambda self: self.env.user.company_id.currency_id)
     payment_date = fields.Date(string='Payment Date', default=fields.Date.context_today, required=True)
     communication = fields.Char(string='Memo')
+    chunk_size = fields.Integer(string='Chunk Size', default=0,
+        help="Number of payslips paid and committed at once. Leave it to 0 to pay the whole batch in a single transaction.")
+    run_in_background = fields.Boolean(string='Run in Background',
+        help="Queue the payment of the batch, it is then paid in chunks by a scheduled worker.")
     hide_payment_method = fields.Boolean(compute='_compute_hide_payment_method',
         help="Technical field used to hide the payment method if the selected journal has only one available which is 'manual'")
 
@@ -37,6 +42,7 @@ class HrPayslipBatchwiseRegisterPaymentWizard(models.TransientModel):
     @api.onchange('journal_id')
     def _onchange_journal(self):
         if self.journal_id:
+            self.currency_id = self.journal_id.currency_id or self.company_id.currency_id
             # Set default payment method (we consider the first to be the default one)
             payment_methods = self.journal_id.outbound_payment_method_ids
             self.payment_method_id = payment_methods and payment_methods[0] or False
@@ -44,48 +50,41 @@ class HrPayslipBatchwiseRegisterPaymentWizard(models.TransientModel):
             return {'domain': {'payment_method_id': [('payment_type', '=', 'outbound'), ('id', 'in', payment_methods.ids)]}}
         return {}
 
+    def _prepare_job_vals(self):
+        """ Hook for extension """
+        return {
+            'payslip_run_id': self.batch_id.id,
+            'company_id': self.company_id.id,
+            'journal_id': self.journal_id.id,
+            'payment_method_id': self.payment_method_id.id,
+            'currency_id': self.currency_id.id,
+            'payment_date': self.payment_date,
+            'communication': self.communication,
+            'consolidate': self.consolidate,
+            'chunk_size': self.chunk_size or 100,
+            'job_type': 'payment',
+        }
+
     @api.multi
+    @profiled('batchwise_register_payment', lambda wizard: wizard.batch_id)
     def expense_post_payment(self):
         self.ensure_one()
+        profiler = get_profiler(self.env)
         for batch_id in self.batch_id:
-            for payslip_lines in batch_id.slip_ids:
-                if not payslip_lines.employee_id.address_home_id:
-                    raise ValidationError(_('Please Define Employee Private Address'))
-
-            for payslip in batch_id.slip_ids:
-                if payslip.state == 'done':
-                    payment_values = {
-                        'partner_type': 'supplier',
-                        'payment_type': 'outbound',
-                        'partner_id': payslip.employee_id.address_home_id.id,
-                        'journal_id': self.journal_id.id,
-                        'company_id': self.company_id.id,
-                        'payment_method_id': self.payment_method_id.id,
-                        'amount': payslip.total_amount,
-                        'currency_id': self.currency_id.id,
-                        'payment_date': self.payment_date,
-                        'communication': self.communication,
-                        'writeoff_label': 'Payslip Payment'
-                    }
+            with profiler.phase('check payslips', len(batch_id.slip_ids)):
+                self._check_payslips(batch_id.slip_ids)
 
-                    # Create payment and post it
-                    payment = self.env['account.payment'].create(payment_values)
-                    payment.post()
-                    # for move in payment.move_line_ids:
-                    #     move.name = +
-                    # Log the payment in the chatter
-                    body = (_("A payment of %s %s with the reference <a href='/mail/view?%s'>%s</a> related to your expense %s has been made.") % (payment.amount, payment.currency_id.symbol, url_encode({'model': 'account.payment', 'res_id': payment.id}), payment.name, payslip.name))
-                    payslip.message_post(body=body)
+            if self.run_in_background:
+                self.env['hr.payslip.run.job'].create(self._prepare_job_vals())
+                continue
+            if self.chunk_size > 0:
+                self.env['hr.payslip.run.job'].create(self._prepare_job_vals())._run()
+                continue
 
-                    # Reconcile the payment and the expense, i.e. lookup on the payable account move lines
-                    account_move_lines_to_reconcile = self.env['account.move.line']
-                    for line in payment.move_line_ids + payslip.move_id.line_ids:
-                        if line.account_id.internal_type == 'payable':
-                            account_move_lines_to_reconcile |= line
-                    account_move_lines_to_reconcile.reconcile()
-                payslip_paid_search = self.env['hr.payslip'].search([('payslip_run_id','=', batch_id.id),('state','=','paid')])
-                if payslip_paid_search:
-                    if len(batch_id.slip_ids) == len(payslip_paid_search):
-                        self.batch_id.write({'state':'paid'})
+            with profiler.phase('select payslips', len(batch_id.slip_ids)):
+                payslips = batch_id.slip_ids.filtered(lambda payslip: payslip.state == 'done')._filter_unpaid()
+            if payslips:
+                self._pay_payslips(payslips)
+            batch_id._check_paid_state()
 
-        return {'type': 'ir.actions.act_window_close'}
\ No newline at end of file
+        return {'type': 'ir.actions.act_window_close'}
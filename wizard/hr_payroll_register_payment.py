@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 import logging
+from collections import defaultdict
 
 from odoo import api, fields, models, _
 from odoo.exceptions import ValidationError
@@ -9,7 +10,10 @@ _logger = logging.getLogger(__name__)
 
 
 class HrPayslipRegisterPaymentWizard(models.TransientModel):
+    """ Register the payment of a payslip, or of a selection of confirmed payslips: these are paid in bulk with
+    one payment per employee, or per payslip, and every employee's payable entries are reconciled together. """
     _name = "hr.payslip.register.payment.wizard"
+    _inherit = ['hr.payslip.payment.mixin']
     _description = "Payslip Register Payment wizard"
 
     def _get_active_payslip(self):
@@ -17,17 +21,22 @@ class HrPayslipRegisterPaymentWizard(models.TransientModel):
         active_ids = context.get('active_ids', [])
         return self.env['hr.payslip'].browse(active_ids)
 
+    def _get_payable_payslips(self):
+        """ Return the selected payslips that are confirmed and waiting for a payment """
+        return self._get_active_payslip().filtered(
+            lambda payslip: payslip.state == 'done' and payslip.residual_company_signed > 0.0)
+
     @api.model
     def _default_partner_id(self):
-        payslip = self._get_active_payslip()
-        return payslip.employee_id.address_home_id.id
+        partner = self._get_active_payslip().mapped('employee_id.address_home_id')
+        return len(partner) == 1 and partner.id or False
 
     def _default_currency_id(self):
         return self.env.user.company_id.currency_id.id
 
     currency_id = fields.Many2one('res.currency', string='Currency', required=True,
                                   default=_default_currency_id)
-    partner_id = fields.Many2one('res.partner', string='Partner', required=True, default=_default_partner_id)
+    partner_id = fields.Many2one('res.partner', string='Partner', default=_default_partner_id)
     journal_id = fields.Many2one('account.journal', string='Payment Method', required=True,
                                  domain=[('type', 'in', ('bank', 'cash'))])
     company_id = fields.Many2one('res.company', related='journal_id.company_id', string='Company', readonly=True,
@@ -41,6 +50,10 @@ class HrPayslipRegisterPaymentWizard(models.TransientModel):
                                       readonly=True)
     payment_date = fields.Date(string='Payment Date', default=fields.Date.context_today, required=True)
     communication = fields.Char(string='Memo')
+    payslip_count = fields.Integer(string='Payslips', compute='_compute_payslip_count')
+    group_by_employee = fields.Boolean(string='One Payment per Employee', default=True,
+                                       help="Pay the selected payslips of an employee with a single payment instead of "
+                                            "one payment per payslip.")
     hide_payment_method = fields.Boolean(compute='_compute_hide_payment_method',
                                          help="Technical field used to hide the payment method if the selected journal has only one available which is 'manual'")
 
@@ -51,21 +64,25 @@ class HrPayslipRegisterPaymentWizard(models.TransientModel):
         else:
             self.currency_id = self.env.user.company_id.currency_id
 
+    def _compute_payslip_count(self):
+        for wizard in self:
+            wizard.payslip_count = len(self._get_active_payslip())
+
     @api.onchange('currency_id', 'payment_date')
     def _onchange_currency_id(self):
-        payslip = self._get_active_payslip()
-        self.amount = self._get_amount(payslip.residual_company_signed)
+        payslip = self._get_payable_payslips()
+        self.amount = self._get_amount(sum(payslip.mapped('residual_company_signed')))
 
     def _get_amount(self, amount):
         if self.currency_id:
-            return self.env.user.company_id.currency_id.with_context(date=self.payment_date).compute(amount,
-                                                                                                     self.currency_id)
+            company = self.env.user.company_id
+            return self._convert_amount(amount, company.currency_id, self.currency_id, company, self.payment_date)
         return amount
 
     @api.onchange('amount', 'currency_id', 'payment_date')
     def _update_residual(self):
-        payslip = self._get_active_payslip()
-        self.amount_residual = self._get_amount(payslip.residual_company_signed) - self.amount
+        payslip = self._get_payable_payslips()
+        self.amount_residual = self._get_amount(sum(payslip.mapped('residual_company_signed'))) - self.amount
 
     @api.one
     @api.constrains('amount')
@@ -110,10 +127,47 @@ class HrPayslipRegisterPaymentWizard(models.TransientModel):
             'payslip_id': self._get_active_payslip().id
         }
 
+    def _prepare_payment_vals(self, payslip):
+        values = super(HrPayslipRegisterPaymentWizard, self)._prepare_payment_vals(payslip)
+        values['amount'] = self._get_amount(payslip.residual_company_signed)
+        return values
+
+    def _prepare_payments_vals(self, payslips):
+        """ Pay the payslips of an employee sharing the same payable account with a single payment """
+        if not self.group_by_employee:
+            return super(HrPayslipRegisterPaymentWizard, self)._prepare_payments_vals(payslips)
+        destination_accounts = payslips._get_destination_accounts()
+        payslips_by_partner = defaultdict(list)
+        for payslip in payslips:
+            key = (payslip.employee_id.address_home_id.id, destination_accounts[payslip.id].id)
+            payslips_by_partner[key].append(payslip)
+        payment_values = []
+        for partner_payslips in payslips_by_partner.values():
+            values = [self._prepare_payment_vals(payslip) for payslip in partner_payslips]
+            if len(values) > 1:
+                values[0].update({
+                    'amount': sum(payslip_values['amount'] for payslip_values in values),
+                    'communication': self.communication or ', '.join(
+                        payslip.number or payslip.name for payslip in partner_payslips),
+                    'payslip_id': False,
+                    'payslip_ids': [(6, 0, [payslip.id for payslip in partner_payslips])],
+                })
+            payment_values.append(values[0])
+        return payment_values
+
     @api.multi
     def expense_post_payment(self):
         self.ensure_one()
+        payslips = self._get_active_payslip()
+        if len(payslips) > 1:
+            payslips = self._get_payable_payslips()
+            if not payslips:
+                raise ValidationError(_('None of the selected payslips is confirmed and waiting for a payment.'))
+            self._pay_payslips(payslips)
+            return {'type': 'ir.actions.act_window_close'}
+
         # Create payment and post it
+        self._check_payslips(payslips)
         payment = self.env['account.payment'].create(self._get_payment_vals())
         payment.post()
 
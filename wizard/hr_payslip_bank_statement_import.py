@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import base64
+import csv
+import io
+import logging
+import re
+from collections import defaultdict
+from datetime import datetime
+
+from lxml import etree
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.tools import DEFAULT_SERVER_DATE_FORMAT
+
+_logger = logging.getLogger(__name__)
+
+
+def _normalize(value):
+    return re.sub(r'\s', '', value or '').upper()
+
+
+def _cents(amount):
+    return int(round(abs(amount) * 100))
+
+
+DATE_FORMATS = [DEFAULT_SERVER_DATE_FORMAT, '%d.%m.%Y', '%d/%m/%Y']
+
+
+def _parse_date(value):
+    """ Return the given statement date, or the date part of an ISO datetime, in the server format """
+    value = (value or '').strip()[:10]
+    if not value:
+        return False
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime(DEFAULT_SERVER_DATE_FORMAT)
+        except ValueError:
+            continue
+    raise ValueError(_("Unknown date format: %s") % value)
+
+
+class HrPayslipBankStatementImportWizard(models.TransientModel):
+    """ Import a bank statement and pay the payslips whose salary transfer it contains. The open payable lines of
+    the confirmed payslips are indexed in memory by amount and employee IBAN, amount and payslip reference, and
+    amount and employee name, so that every statement line is matched in constant time. All the lines are put on a
+    bank statement, the matched ones being reconciled with the payable items of their payslip; the other lines are
+    left for review. """
+    _name = "hr.payslip.bank.statement.import.wizard"
+    _description = "Payslip Bank Statement Import wizard"
+
+    data_file = fields.Binary(string='Bank Statement File', required=True)
+    filename = fields.Char(string='File Name')
+    file_format = fields.Selection([
+        ('csv', 'CSV'),
+        ('camt', 'CAMT.053'),
+    ], string='File Format', required=True, default='csv',
+        help="CSV files hold a header line with the date, amount, iban, reference and name columns.")
+    journal_id = fields.Many2one('account.journal', string='Bank Journal', required=True,
+                                 domain=[('type', '=', 'bank')])
+
+    def _parse_csv(self, data):
+        reader = csv.DictReader(io.StringIO(data.decode('utf-8-sig')), delimiter=';')
+        for row in reader:
+            row = {(key or '').strip().lower(): (value or '').strip() for key, value in row.items()}
+            yield {
+                'date': _parse_date(row.get('date')),
+                'amount': float(row.get('amount', '0').replace(',', '.') or 0.0),
+                'iban': row.get('iban'),
+                'ref': row.get('reference'),
+                'name': row.get('name'),
+            }
+
+    def _parse_camt(self, data):
+        def find(element, path):
+            found = element.xpath(path)
+            return found and (found[0].text or '').strip() or ''
+
+        for event, entry in etree.iterparse(io.BytesIO(data), events=('end',), tag='{*}Ntry'):
+            amount = float(find(entry, '*[local-name()="Amt"]') or 0.0)
+            if find(entry, '*[local-name()="CdtDbtInd"]') == 'DBIT':
+                amount = -amount
+            details = './/*[local-name()="TxDtls"]'
+            yield {
+                'date': _parse_date(find(entry, '*[local-name()="BookgDt"]/*') or
+                                    find(entry, '*[local-name()="ValDt"]/*')),
+                'amount': amount,
+                'iban': find(entry, details + '//*[local-name()="CdtrAcct"]//*[local-name()="IBAN"]'),
+                'ref': find(entry, details + '//*[local-name()="RmtInf"]/*[local-name()="Ustrd"]') or
+                       find(entry, details + '//*[local-name()="EndToEndId"]'),
+                'name': find(entry, details + '//*[local-name()="Cdtr"]/*[local-name()="Nm"]'),
+            }
+            entry.clear()
+
+    def _get_open_payables(self):
+        """ Return the open payable lines of the confirmed payslips of the company, one per payslip, as
+        (payslip id, residual, employee IBAN, payslip references, employee name) tuples. """
+        self.env.cr.execute("""
+            SELECT slip.id, SUM(aml.amount_residual), bank.acc_number, slip.number, move.name, move.ref,
+                   partner.name
+              FROM hr_payslip slip
+              JOIN hr_employee employee ON employee.id = slip.employee_id
+              JOIN res_partner partner ON partner.id = employee.address_home_id
+              JOIN account_move move ON move.id = slip.move_id
+              JOIN account_move_line aml ON aml.move_id = move.id AND aml.partner_id = partner.id
+                                         AND (aml.payslip_id IS NULL OR aml.payslip_id = slip.id)
+              JOIN account_account account ON account.id = aml.account_id
+         LEFT JOIN res_partner_bank bank ON bank.id = employee.bank_account_id
+             WHERE slip.state = 'done' AND slip.company_id = %s
+               AND account.internal_type = 'payable' AND aml.reconciled IS NOT TRUE
+          GROUP BY slip.id, bank.acc_number, slip.number, move.name, move.ref, partner.name
+        """, (self.journal_id.company_id.id,))
+        return self.env.cr.fetchall()
+
+    def _build_index(self):
+        index = defaultdict(list)
+        for payslip_id, residual, iban, number, move_name, move_ref, name in self._get_open_payables():
+            cents = _cents(residual)
+            if iban:
+                index[('iban', cents, _normalize(iban))].append(payslip_id)
+            for reference in set([number, move_name, move_ref]):
+                if reference:
+                    index[('ref', cents, _normalize(reference))].append(payslip_id)
+            if name:
+                index[('name', cents, _normalize(name))].append(payslip_id)
+        return index
+
+    def _match(self, index, line, matched):
+        cents = _cents(line['amount'])
+        for key in (('iban', cents, _normalize(line['iban'])),
+                    ('ref', cents, _normalize(line['ref'])),
+                    ('name', cents, _normalize(line['name']))):
+            for payslip_id in index.get(key, ()):
+                if payslip_id not in matched:
+                    return payslip_id
+        return False
+
+    def _create_statement(self, lines, partner_ids):
+        """ Put the lines on a bank statement, in the order of the file, with the partners given per line index """
+        return self.env['account.bank.statement'].create({
+            'name': self.filename or _('Salary Statement'),
+            'journal_id': self.journal_id.id,
+            'date': fields.Date.context_today(self),
+            'line_ids': [(0, 0, {
+                'sequence': sequence,
+                'date': line['date'] or fields.Date.context_today(self),
+                'name': line['ref'] or line['name'] or '/',
+                'ref': line['ref'],
+                'amount': line['amount'],
+                'partner_id': partner_ids.get(sequence, False),
+            }) for sequence, line in enumerate(lines)],
+        })
+
+    def _reconcile_statement_line(self, statement_line, payslip):
+        """ Reconcile a statement line with the open payable items of the payslip it pays, and return the payment
+        created by the reconciliation. """
+        partner = payslip.employee_id.address_home_id
+        move_lines = payslip._get_move_lines().filtered(
+            lambda line: line.account_id.internal_type == 'payable' and not line.reconciled and
+            line.partner_id == partner)
+        statement_line.process_reconciliation(counterpart_aml_dicts=[{
+            'move_line': line,
+            'name': line.name,
+            'debit': line.amount_residual < 0.0 and -line.amount_residual or 0.0,
+            'credit': line.amount_residual > 0.0 and line.amount_residual or 0.0,
+        } for line in move_lines])
+        return statement_line.journal_entry_ids.mapped('payment_id')
+
+    def _link_payments(self, payslip_ids_by_payment):
+        """ Link the payments created by the reconciliations to their payslip with a single update """
+        if not payslip_ids_by_payment:
+            return
+        self.env.cr.execute("""
+            UPDATE account_payment payment SET payslip_id = link.payslip_id
+              FROM (VALUES {values}) AS link (payment_id, payslip_id)
+             WHERE payment.id = link.payment_id
+        """.format(values=', '.join(['(%s, %s)'] * len(payslip_ids_by_payment))),
+            [value for item in payslip_ids_by_payment.items() for value in item])
+        payments = self.env['account.payment'].browse(list(payslip_ids_by_payment))
+        payments.invalidate_cache(['payslip_id'], payments.ids)
+        self.env['hr.payslip'].invalidate_cache(['payment_ids'])
+        # the residuals of the payslips depend on their payments
+        payments.modified(['payslip_id'])
+
+    @api.multi
+    def import_file(self):
+        self.ensure_one()
+        data = base64.b64decode(self.data_file)
+        parser = self.file_format == 'camt' and self._parse_camt or self._parse_csv
+        try:
+            lines = list(parser(data))
+        except (ValueError, etree.XMLSyntaxError) as e:
+            raise UserError(_('The bank statement file could not be read: %s') % e)
+
+        index = self._build_index()
+        matched = {}
+        payslip_ids_by_sequence = {}
+        for sequence, line in enumerate(lines):
+            payslip_id = line['amount'] < 0.0 and self._match(index, line, matched)
+            if payslip_id:
+                matched[payslip_id] = line
+                payslip_ids_by_sequence[sequence] = payslip_id
+        _logger.info("Bank statement %s: %d lines matched to payslips, %d left for review",
+                     self.filename, len(matched), len(lines) - len(matched))
+
+        Payslip = self.env['hr.payslip']
+        statement = self._create_statement(lines, {
+            sequence: Payslip.browse(payslip_id).employee_id.address_home_id.id
+            for sequence, payslip_id in payslip_ids_by_sequence.items()})
+
+        # reconcile the matched lines, then set the payslips to paid and refresh their liabilities at once
+        queue = set()
+        payments = []
+        payslip_ids_by_payment = {}
+        currency = statement.currency_id or statement.company_id.currency_id
+        for statement_line in statement.with_context(payslip_defer_paid_state=True,
+                                                     payslip_liability_queue=queue).line_ids:
+            payslip_id = payslip_ids_by_sequence.get(statement_line.sequence)
+            if payslip_id:
+                payslip = Payslip.browse(payslip_id)
+                payment = self._reconcile_statement_line(statement_line, payslip)
+                if payment:
+                    payslip_ids_by_payment[payment.id] = payslip_id
+                payments.append((payslip, payment or statement_line.journal_entry_ids[:1],
+                                 abs(statement_line.amount), currency))
+        self._link_payments(payslip_ids_by_payment)
+        payslips = Payslip.browse(list(matched))
+        payslips._set_paid_if_reconciled()
+        self.env['hr.payslip.liability']._refresh(payslips | Payslip.browse(list(queue)))
+        Payslip._post_payment_messages(payments)
+
+        if len(matched) == len(lines):
+            return {'type': 'ir.actions.act_window_close'}
+        return {
+            'name': _('Bank Statement'),
+            'type': 'ir.actions.act_window',
+            'res_model': 'account.bank.statement',
+            'view_mode': 'form',
+            'view_type': 'form',
+            'res_id': statement.id,
+        }